@@ -6,11 +6,16 @@
 VERSION = '0.1.5'
 
 from sys import argv, stdin, stdout, stderr, exit
-from getopt import getopt, GetoptError
-from argparse import ArgumentParser, ArgumentTypeError, RawDescriptionHelpFormatter
+import time
+# The end of each phase of startup, for --startup-profile. Modules that
+# are only needed by some options are imported where they are used.
+STARTUP = [('start', time.perf_counter())]
 
-import random, time, termios, tty
+import mmap, os, random
+from itertools import islice
+STARTUP.append(('import modules', time.perf_counter()))
 import chiplib
+STARTUP.append(('import chiplib', time.perf_counter()))
 
 class ConfigDict(dict):
 	def __getattr__(self, name):
@@ -21,17 +26,48 @@ class ConfigDict(dict):
 		else:
 			raise KeyError(name)
 Cfg = ConfigDict(
+	BATCH=False,
+	CACHE_DIR=None,
+	CONNECT=None,
 	CUTOFF_BYTES=-1,
+	EMIT=None,
+	FLAMEGRAPH=None,
+	ENGINE=None,
 	ESC_SEQS=tuple(),
 	GENERATOR=None,
+	GENERATOR_TEMPLATE=None,
+	HISTORY_LIMIT=-1,
 	IGNORE_EOF=False,
+	INPUT=None,
+	INSTRUMENT=False,
+	LANES=64,
 	NEWLINE=False,
 	NO_BUFFER=False,
+	PROFILE=None,
+	SEPARATOR=b'\n',
+	SERVE=None,
+	SPECS=tuple(),
 	STORAGE=None,
+	STORAGE_LIMIT=None,
+	STORAGE_OVERFLOW='drop',
 	VERBOSE=False,
+	STARTUP_PROFILE=False,
 	WITHOUT_STDIN=False
 )
 
+def startupPhase(name):
+	"""Mark the end of a phase of startup, when it is being profiled"""
+	if Cfg.STARTUP_PROFILE:
+		STARTUP.append((name, time.perf_counter()))
+
+def startupReport():
+	"""Gives the time taken by each phase of startup so far"""
+	out = 'Startup:\n'
+	for (_, begin), (name, end) in zip(STARTUP, STARTUP[1:]):
+		out += '%s ms %s\n' % (format((end-begin)*1000, '.3f').rjust(12), name)
+	out += '%s ms %s\n' % (format((STARTUP[-1][1]-STARTUP[0][1])*1000, '.3f').rjust(12), 'total')
+	return out
+
 def prepareGenerator(template):
 	def inputGenerator():
 		digits = '0123456789ABCDEF'
@@ -57,31 +93,75 @@ def prepareGenerator(template):
 			age = (age + 1) % 256
 	return inputGenerator()
 
-def prepareStorage(mode):
-	valid_modes = {'q', 's'} # 'm' not yet implemented, will need 2 heads. Ditto for 'ss', 'qq', 'qs', and 'sq'.
-	if not (set(mode) <= valid_modes):
-		raise ArgumentTypeError("'%s' is not a valid storage mode. Valid modes are: %s" % (mode, str(valid_modes).strip('{}')))
-	return mode
+CHUNK_SIZE = 1 << 16
+FLUSH_LATENCY = 1/100
 
-def init():
-	"""Perform initialization tasks"""
+def validElements():
+	"""Gives the table of element types and their lexemes, for the help"""
 	justify = max(len(cls.__name__) for cls in chiplib.lexmap_r.keys()) + 2
 	valid_elements = 'supported elements:\n  '+'Type'.ljust(justify)+'Lexemes\n'
 	for cls, lexes in sorted([(cls.__name__, lexes) for cls, lexes in chiplib.lexmap_r.items()]):
 		valid_elements += '  %s%s\n' % (cls.ljust(justify), ' '.join(sorted(lexes)))
+	return valid_elements
+
+def init():
+	"""Perform initialization tasks"""
+	from argparse import ArgumentParser, RawDescriptionHelpFormatter, SUPPRESS
+
+	class Parser(ArgumentParser):
+		def format_help(self):
+			# The table of elements is only made when the help is shown
+			self.epilog = validElements()
+			return ArgumentParser.format_help(self)
 
-	parser = ArgumentParser(usage='%(prog)s [options] <chipspec>', conflict_handler='resolve',
-	                        formatter_class=RawDescriptionHelpFormatter, epilog=valid_elements)
+	parser = Parser(usage='%(prog)s [options] <chipspec> [input]\n'+
+	                      '       %(prog)s [options] --serve SOCKET <chipspec> [chipspec ...]\n'+
+	                      '       %(prog)s [options] --connect SOCKET <chipspec> [input]', conflict_handler='resolve',
+	                formatter_class=RawDescriptionHelpFormatter)
 	# Positional args
 	parser.add_argument('chipspec', action='store', type=str, nargs='?', metavar='chipspec', help='A Chip specification file.')
+	parser.add_argument('input', action='store', type=str, nargs='?', metavar='input', help='A file to read input from, '+
+	                             'instead of stdin. It is mapped into memory rather than read, so bookmarks (V) can go '+
+	                             'back to any part of it.')
+	parser.add_argument('specs', action='store', type=str, nargs='*', help=SUPPRESS)
 	# Optional args
+	parser.add_argument('-b', '--batch', action='store_true', dest='batch', default=False, help='Batch mode; stdin is split '+
+	                                     'into records (see --separator), and each record is run through the circuit as an '+
+	                                     'independent stream. Outputs are written in the same order, each followed by the '+
+	                                     'separator. Streams are evaluated together, bit-sliced across the lanes of the '+
+	                                     'netlist, and sleep/pause elements are ignored.')
+	parser.add_argument('--cache-dir', action='store', dest='cache_dir', default=None, type=str, metavar='DIR', help='Cache '+
+	                                   'the compiled form of the spec in DIR, keyed by a hash of the spec, the interpreter '+
+	                                   'version and the format of what is cached, and use it when the same spec is run '+
+	                                   'again, rather than parsing the spec and joining its wires anew.')
 	parser.add_argument('-c', '--cutoff', action='store', dest='cutoff_bytes', default=-1, type=int, metavar='N', help='Stop '+
 	                                      'processing and halt after N bytes; applies to both stdin and generated bytes.')
+	parser.add_argument('--connect', action='store', dest='connect', default=None, type=str, metavar='SOCKET', help='Run '+
+	                                 'the input through a circuit of the server listening on SOCKET (see --serve), and write '+
+	                                 'its output, rather than loading the circuit here. The circuit is named by chipspec, '+
+	                                 'whose file name is used without its extension. With -b, each record is sent as its own '+
+	                                 'message. Other options are those the server was started with.')
 	parser.add_argument('-e', '--escape', action='append', dest='esc_seqs', metavar='SEQ', help='Use these characters as escape '+
 	                                      'sequences for input. A default of ^C and ^D are included in immediate mode (-i) when '+
 	                                      'stdin is a tty, unless an empty esc sequence is provided. If a sequence is multiple '+
 	                                      'characters, they must be entered in order. All characters except the last are echoed to '+
 	                                      'the script. Multiple sequences may be defined.')
+	parser.add_argument('--emit', action='store', dest='emit', default=None, type=str, metavar='FILE', help='Write the Python '+
+	                              'source generated for the circuit (as used by the codegen engine) to FILE.')
+	parser.add_argument('--engine', action='store', dest='engine', default=None, choices=chiplib.ENGINES, help='Select how the '+
+	                                "circuit is evaluated. 'poll' pulls each signal recursively through the board, cell by "+
+	                                "cell. 'memo' polls in the same way, but keeps each signal it has polled until the end of "+
+	                                "the cycle, rather than polling it again. 'iterative' also polls, but keeps its own stack "+
+	                                'rather than recursing, so paths of any depth can be followed, and each signal is polled once '+
+	                                "per cycle. 'netlist' first compiles the board into a flat netlist of gates and state "+
+	                                'cells, which is evaluated in a single linear pass per cycle. \'codegen\' compiles that '+
+	                                'netlist further, into Python source specialized for the circuit. By default, a circuit '+
+	                                'with little enough state is run from a table of its outputs and next states, and any '+
+	                                'other circuit uses poll.')
+	parser.add_argument('--flamegraph', action='store', dest='flamegraph', default=None, type=str, metavar='FILE', help='Profile '+
+	                                    'the circuit as with --profile, and write the stacks of polls to FILE, in the collapsed '+
+	                                    'format read by flamegraph tools. Each frame is an element type and its (layer, row, '+
+	                                    'column), and each stack is weighted by its own time, in microseconds.')
 	parser.add_argument('-g', '--generate', action='store', dest='generator', default='', type=str, metavar='XX', help='When input '+
 	                                        'is exhausted, instead of terminating, generate values defined by XX. XX is two digits '+
 	                                        "of base 16, or special characters 'I', 'J', or 'K'. 'I' means count up, 'J' means "+
@@ -89,20 +169,63 @@ def init():
 	                                        'low four bits are always 0101, and the upper four bits will increment every 16 cycles. '+
 	                                        'Any counting starts at the end of stdin. Case insensitive.')
 	parser.add_argument('-h', '--help', action='help', help='Show this help message and exit.')
-	parser.add_argument('-i', '--immediate', action='store_true', dest='no_buffer', default=False, help='Flushes stdout immediately '+
-	                                         'after each cycle, otherwise, default buffering is used. Also sets input to raw mode, '+
+	parser.add_argument('--history-limit', action='store', dest='history_limit', default=-1, type=int, metavar='N', help='Keep '+
+	                                       'at most N bytes of past input for bookmarks (V) to go back to. A bookmark that '+
+	                                       'goes back further only goes back to the oldest byte kept. Input older than the '+
+	                                       'earliest bookmark still marked is never kept, with or without this limit.')
+	parser.add_argument('-i', '--immediate', action='store_true', dest='no_buffer', default=False, help='Flushes stdout within '+
+	                                         'about 1/100 s of each output, otherwise output is written in large blocks. Either way, '+
+	                                         'stdout is flushed before waiting for input or sleeping. Also sets input to raw mode, '+
 	                                         'rather than cbreak mode.')
-	parser.add_argument('-m', '--storage-mode', action='store', dest='storage', default='s', type=prepareStorage, metavar='MODE',
+	parser.add_argument('--lanes', action='store', dest='lanes', default=64, type=int, metavar='N', help='The number of '+
+	                               'streams evaluated together in batch mode (-b). Any positive number may be used; '+
+	                               'the default is 64.')
+	parser.add_argument('-m', '--storage-mode', action='store', dest='storage', default='s', type=str, metavar='MODE',
 	                                            help="Set the storage to this mode. 's' means stack, 'q' means queue, 'm' "+
-	                                            'means addressed memory (not yet implemented). Stack is the default mode.')
+	                                            'means addressed memory, of 256 words. In memory mode, 01234567 read the word at the '+
+	                                            'current address, 9 writes the storage bits there, and 8 moves to the address given '+
+	                                            'on the storage bits, to be read from the next cycle. A second letter adds a second '+
+	                                            'storage unit of that mode, with its own bits (⓪①②③④⑤⑥⑦) and controls (⑨ writes, '+
+	                                            "⑧ reads), as in 'sq' or 'ss'. Stack is the default mode.")
 	parser.add_argument('-n', '--extra-newline', action='store_true', dest='extra_newline', default=False, help='Provides an extra '+
 	                                             'newline to stdout at the end of execution regardless of the method of termination.')
 	parser.add_argument('-o', '--generate-ones', action='store_const', dest='generator', const='FF', help='When input is exhausted, '+
 	                                             'instead of terminating, generate one values (0xff) until the circuit terminates '+
 	                                             'itself. Equivalent to --generate=FF.')
+	parser.add_argument('--profile', action='store', dest='profile', default=None, type=str, metavar='FILE', help='Run the '+
+	                                 'circuit with the poll engine, timing each poll, and write a JSON report to FILE when '+
+	                                 'execution ends. It gives the time and polls of each element, inclusive and exclusive of '+
+	                                 'the polls it makes, the time of each terminal class, and the latency of the cycles.')
+	parser.add_argument('--startup-profile', action='store_true', dest='startup_profile', default=False, help='Report '+
+	                                         'to stderr how long each phase of startup took, from importing modules to '+
+	                                         'preparing the engine, before the circuit is run. The time taken by the '+
+	                                         'interpreter to start is not included.')
+	parser.add_argument('--serve', action='store', dest='serve', default=None, type=str, metavar='SOCKET', help='Load '+
+	                               'each chipspec given once, and serve its circuit on the Unix socket SOCKET until '+
+	                               'interrupted. Each circuit is named by its file name, without the extension. A '+
+	                               'connection names a circuit, and then sends any number of messages, each of which is '+
+	                               'run from a fresh state, as a record is in batch mode (-b). Messages from all of the '+
+	                               'connections are evaluated together, across the lanes of the netlist. The replies are '+
+	                               'sent in the order of the messages, each as soon as it is ready, while later messages '+
+	                               'are still read, so a client may send all of its messages before reading any reply. '+
+	                               'Each message, and the reply to it, is framed by its length, as 4 bytes, big-endian, and '+
+	                               'a reply starts with a byte that is 0 for output, or 1 for an error.')
+	parser.add_argument('--separator', action='store', dest='separator', default='\\n', type=str, metavar='SEP', help='The '+
+	                                   'sequence that separates records in batch mode (-b). Escapes are processed as for -e. '+
+	                                   'The default is a newline.')
+	parser.add_argument('--storage-limit', action='store', dest='storage_limit', default=None, type=int, metavar='N', help='Hold '+
+	                                       'at most N words in storage. See --storage-overflow for what happens to a write to '+
+	                                       'full storage. By default, storage is unlimited.')
+	parser.add_argument('--storage-overflow', action='store', dest='storage_overflow', default='drop',
+	                                          choices=chiplib.STORAGE_OVERFLOWS, help='Set what happens to a write to '+
+	                                          "full storage (see --storage-limit). 'drop' discards the word written. 'oldest' "+
+	                                          "discards the oldest word held, to make room. 'halt' discards the word written, and "+
+	                                          "terminates execution, as t does. 'spill' moves the older half of a stack out to a "+
+	                                          'temporary file, and is only valid for stacks. The default is drop.')
 	parser.add_argument('-v', '--verbose', action='count', dest='verbose', default=0, help='Enables verbose output; effect is '+
 	                                       'cumulative. Level 1 shows input/output for each cycle. Level 2 adds the parsed '+
-	                                       'circuitry and statistics. Level 3 shows a heatmap (using ANSI colors).')
+	                                       'circuitry, statistics, and debug (X) messages, none of which are kept at lower '+
+	                                       'levels. Level 3 shows a heatmap (using ANSI colors).')
 	parser.add_argument('-V', '--version', action='version', version=('Chip interpreter v'+VERSION), help="Show interpreter's "+
 	                                       'version number and exit.')
 	parser.add_argument('-w', '--without-stdin', action='store_true', dest='without', default=False, help='The program uses the '+
@@ -112,17 +235,48 @@ def init():
 	                                               'exhausted, instead of terminating, generate zero values (0x00) until the circuit '+
 	                                               'terminates itself. Equivalent to --generate=00.')
 	args = parser.parse_args()
+	Cfg.STARTUP_PROFILE = args.startup_profile
+	startupPhase('parse arguments')
+
+	try:
+		chiplib.checkOptions(args.storage, args.storage_limit, args.storage_overflow, args.engine or 'poll', args.lanes)
+	except ValueError as e:
+		parser.error(str(e))
+
+	if (args.profile or args.flamegraph) and (args.batch or args.serve or args.engine not in (None, 'poll')):
+		parser.error('profiling is only done with the poll engine, and not in batch or server mode')
+	if args.serve and args.connect:
+		parser.error('a server cannot also connect to a server')
+	if args.specs and not args.serve:
+		parser.error('unrecognized arguments: %s' % (' '.join(args.specs)))
 
 	if args.without and not args.generator:
 		args.generator = '00'
 
+	Cfg.BATCH = args.batch
+	Cfg.CACHE_DIR = args.cache_dir
+	Cfg.CONNECT = args.connect
 	Cfg.CUTOFF_BYTES = args.cutoff_bytes
+	Cfg.EMIT = args.emit
+	Cfg.FLAMEGRAPH = args.flamegraph
+	Cfg.ENGINE = args.engine
 	Cfg.IGNORE_EOF = bool(args.generator)
+	Cfg.INPUT = args.input
 	Cfg.GENERATOR = prepareGenerator(args.generator)
+	Cfg.GENERATOR_TEMPLATE = args.generator
+	Cfg.HISTORY_LIMIT = args.history_limit
+	Cfg.LANES = args.lanes
 	Cfg.NEWLINE = args.extra_newline
+	Cfg.SEPARATOR = args.separator.encode('utf-8').decode('unicode_escape').encode('utf-8')
 	Cfg.NO_BUFFER = args.no_buffer
+	Cfg.PROFILE = args.profile
+	Cfg.SERVE = args.serve
 	Cfg.STORAGE = args.storage
+	Cfg.STORAGE_LIMIT = args.storage_limit
+	Cfg.STORAGE_OVERFLOW = args.storage_overflow
 	Cfg.VERBOSE = args.verbose
+	# Only level 2 and up show the stats, heatmap, and debug messages
+	Cfg.INSTRUMENT = Cfg.VERBOSE > 1
 	Cfg.WITHOUT_STDIN = args.without
 
 	esc_seqs_str = []
@@ -138,79 +292,92 @@ def init():
 		stderr.write('Escape sequences are: ' + repr(Cfg.ESC_SEQS) + '\n')
 
 	if args.chipspec:
-		with open(args.chipspec, 'r') as f:
-			arr = f.readlines()
-			if len(arr) > 0 and arr[0].startswith("#!"):
-				# Its a shebang, probably. Remove the whole line.
-				arr = arr[1:]
-			return ''.join(arr)
+		if args.serve:
+			# The specs are read by the server, and input is another spec
+			Cfg.INPUT = None
+			Cfg.SPECS = tuple([args.chipspec] + ([args.input] if args.input else []) + args.specs)
+			return None
+		if args.connect:
+			# The spec is read by the server
+			Cfg.SPECS = (args.chipspec,)
+			return None
+		spec = readSpec(args.chipspec)
+		startupPhase('read spec')
+		return spec
 	else:
 		parser.print_help()
 		exit(2)
 
+def readSpec(path):
+	"""Gives the text specification in the file at path"""
+	with open(path, 'r') as f:
+		return chiplib.stripShebang(f.read())
+
+def cachePath(ospec):
+	"""Gives the file that the compiled form of the spec is cached in"""
+	import hashlib, marshal
+	key = hashlib.sha256(('%s\n%d\n%d\n' % (VERSION, chiplib.FORMAT, marshal.version)).encode('utf-8') + ospec.encode('utf-8'))
+	return os.path.join(Cfg.CACHE_DIR, key.hexdigest() + '.chc')
+
+def readCache(path):
+	"""Gives the warnings, layers, and nets cached in path, or None if
+	   there is no usable entry"""
+	import marshal
+	try:
+		with open(path, 'rb') as f:
+			warnings, spec2, nets = marshal.load(f)
+		return warnings, spec2, nets
+	except (OSError, EOFError, ValueError, TypeError):
+		return None
+
+def writeCache(path, entry):
+	"""Write entry to path, through a temporary file, so that a reader
+	   never sees it half written"""
+	import marshal, tempfile
+	try:
+		os.makedirs(Cfg.CACHE_DIR, exist_ok=True)
+		fd, tmp = tempfile.mkstemp(dir=Cfg.CACHE_DIR, suffix='.tmp')
+		with os.fdopen(fd, 'wb') as f:
+			marshal.dump(entry, f)
+		os.replace(tmp, path)
+	except OSError as e:
+		stderr.write('WARN: could not write to the cache: %s\n' % (e))
+
 def setup(ospec):
 	"""Prepare the circuitry from the text specification"""
-	spec = list(ospec)
-	# Cleanup comments and check symbols
-	charlist = ''.join(chiplib.lexmap.keys())
-	blockcomment = False
-	layercomment = False
-	for char in range(len(spec)):
-		if spec[char] == '\n':
-			layercomment = False
-		elif blockcomment and spec[char] == ';':
-			blockcomment = False
-			spec[char] = ' '
-		elif spec[char] == '=' and (char == 0 or spec[char-1] == '\n'):
-			layercomment = True
-		elif (not layercomment) and spec[char] == ':':
-			blockcomment = True
-			spec[char] = ' '
-		elif blockcomment or layercomment:
-			spec[char] = ' '
-		else:
-			# Check if a valid char
-			msg = None
-			if spec[char] == '=':
-				msg = "'=' must only be found at the beginning of a line, or in a comment"
-			elif spec[char] == ';':
-				msg = "';' must only be used to terminate a block comment, or found within a layer comment"
-			elif spec[char] not in charlist:
-				msg = "'%s' (%d) is not a valid character" % (spec[char], ord(spec[char]))
-			if msg:
-				slice = ''.join(spec[:char])
-				row = slice.count('\n')+1
-				col = len(slice) - slice.rfind('\n')
-				stderr.write("%d:%d WARN: %s\n" % (row, col, msg))
-				spec[char] = ' '
-	spec = list(map(lambda x:x.rstrip(), ''.join(spec).split('\n')))
-	# Cleanup unnecessary lines
-	layertail = True
-	for line in range(len(spec)-1, -1, -1):
-		if spec[line] == '':
-			if layertail:
-				spec = spec[:line] + spec[line+1:]
-			else:
-				pass
-		elif spec[line] == '=':
-			layertail = True
-		else:
-			layertail = False
-	if len(spec) > 0 and spec[0] == '=':
-		spec = spec[1:]
-	spec = '\n'.join(spec)
-
-	# Convert to final layout
-	spec2 = list(map(lambda s: s[(1 if len(s) > 0 and s[0] == '\n' else None):].rstrip('\n'), spec.split('=')))
-	n = max(map(lambda s:s.count('\n'), spec2))
-	spec2 = list(map(lambda s:(s+('\n'*(n-s.count('\n')))).split('\n'), spec2))
-	n = max(map(lambda s:max(map(len, s)), spec2))
-	spec2 = list(map(lambda s:list(map(lambda t:list(t+(' '*(n-len(t)))), s)), spec2))
+	# A cached spec skips cleaning and layout, and the solving of its nets
+	path = cachePath(ospec) if Cfg.CACHE_DIR else None
+	cached = readCache(path) if path else None
+	if cached is None:
+		warnings = []
+		spec2 = chiplib.layoutSpec(ospec, warnings)
+		nets = None
+	else:
+		warnings, spec2, nets = cached
+	for warning in warnings:
+		stderr.write(warning)
+	startupPhase('lay out spec' if cached is None else 'read cache')
 
 	board = chiplib.Board(Cfg)
-	board.initialize([[[chiplib.getElementType(char)(board, x, y, z, char) for x,char in enumerate(row)] for y,row in enumerate(layer)] for z,layer in enumerate(spec2)])
+	cboard = [[[chiplib.getElementType(char)(board, x, y, z, char) for x,char in enumerate(row)] for y,row in enumerate(layer)] for z,layer in enumerate(spec2)]
+	startupPhase('make elements')
+	board.initialize(cboard, nets)
+	startupPhase('solve nets' if nets is None else 'load nets')
+	if path and cached is None:
+		writeCache(path, (warnings, spec2, board.saveNets()))
+		startupPhase('write cache')
 	if Cfg.VERBOSE > 1:
 		stderr.write(str(board) + '\n')
+	engine = chiplib.makeEngine(board, Cfg.ENGINE or 'poll')
+	if Cfg.EMIT:
+		codegen = engine if Cfg.ENGINE == 'codegen' else chiplib.Codegen(chiplib.Netlist(board))
+		with open(Cfg.EMIT, 'w') as f:
+			f.write(codegen.source)
+	if Cfg.PROFILE or Cfg.FLAMEGRAPH:
+		engine = chiplib.Profiler(board)
+	if Cfg.VERBOSE > 1 and engine is not board:
+		stderr.write(repr(engine) + '\n')
+	startupPhase('prepare engine')
 
 	def circuit_gen():
 		"""A generator representing the board's state and function"""
@@ -222,26 +389,25 @@ def setup(ospec):
 		try:
 			while True:
 				inbits = yield result
-				result = board.run(inbits)
+				result = engine.run(inbits)
 		except KeyboardInterrupt as e:
 			if result.debug:
 				for msg in sorted(result.debug):
 					stderr.write('\n\t\t\t\t\t%s(%d,%d,%d): %s' % msg)
 			if Cfg.VERBOSE > 2:
 				stderr.write('\n' + board.heatmap())
-			stderr.write('\nStack: ' if Cfg.STORAGE[0] == 's' else '\nQueue: ')
-			if board.storage:
-				dir = -1 if Cfg.STORAGE[0] == 's' else 1
-				if Cfg.VERBOSE > 1 or len(board.storage) < 9:
-					stderr.write(' '.join(map(lambda v:''.join(map(str, v[::-1])), board.storage[::dir])))
+			for unit, storage in enumerate(board.storages):
+				stderr.write('\n%s%s: ' % (storage.name.capitalize(), ' 2' if unit else ''))
+				if storage:
+					if Cfg.VERBOSE > 1 or len(storage) < 9:
+						stderr.write(' '.join(map(lambda v:format(v, '08b'), storage.words())))
+					else:
+						stderr.write(' '.join(map(lambda v:format(v, '08b'), storage.words(8))))
+						stderr.write(' ... ')
+						stderr.write(str(len(storage)-8))
+						stderr.write('more')
 				else:
-					cut = -9 if Cfg.STORAGE[0] == 's' else 8
-					stderr.write(' '.join(map(lambda v:''.join(map(str, v[::-1])), board.storage[:cut:dir])))
-					stderr.write(' ... ')
-					stderr.write(str(len(board.storage)-8))
-					stderr.write('more')
-			else:
-				stderr.write('empty')
+					stderr.write('empty')
 			stderr.write('\nAge: ')
 			stderr.write(str(board.age))
 			if (board.stats):
@@ -255,17 +421,128 @@ def setup(ospec):
 	circuit = circuit_gen()
 	circuit.send(None)
 
-	return circuit, board
+	return circuit, board, engine
+
+class MappedHistory(chiplib.History):
+	"""The input given to the circuit from a file mapped into memory,
+	   followed by any input generated after its end. The file is never
+	   copied, and all of it can be read again; only the generated input
+	   is held and dropped as in History."""
+
+	def __init__(self, mapped):
+		chiplib.History.__init__(self)
+		self.mapped = mapped
+		self.start = len(mapped)
+	def __getitem__(self, span):
+		size = len(self.mapped)
+		if span.stop <= size:
+			return self.mapped[span.start:span.stop]
+		return self.mapped[span.start:size] + chiplib.History.__getitem__(self, slice(max(span.start, size), span.stop))
+
+	def clamp(self, index):
+		return index if index < len(self.mapped) else chiplib.History.clamp(self, index)
+
+class Output(object):
+	"""Collects output bytes, and writes them to stream a block at a
+	   time. A block is written once it holds size bytes, once its first
+	   byte has waited latency seconds (if latency is set), or when flush
+	   is called, such as before reading input that may block."""
+
+	def __init__(self, stream, size=CHUNK_SIZE, latency=None):
+		self.stream = stream
+		self.size = size
+		self.latency = latency
+		self.data = bytearray()
+		self.since = None
 
-def run(circuit, board):
+	def write(self, byte):
+		self.data.append(byte)
+		if len(self.data) >= self.size:
+			self.flush()
+		elif self.since is None and self.latency is not None:
+			self.since = time.monotonic()
+	def expire(self):
+		"""Flush once the first byte of the block has waited latency
+		   seconds, whether or not any byte has been written since"""
+		if self.since is not None and time.monotonic() - self.since >= self.latency:
+			self.flush()
+	def flush(self):
+		if self.data:
+			self.stream.write(self.data)
+			self.stream.flush()
+			self.data.clear()
+		self.since = None
+
+def mapInput(path):
+	"""Map the input file into memory, read only"""
+	with open(path, 'rb') as f:
+		try:
+			return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			# An empty file cannot be mapped
+			return b''
+
+def openInput():
+	"""Gives the input file if there is one, or stdin"""
+	if Cfg.INPUT is not None:
+		return open(Cfg.INPUT, 'rb')
+	return stdin.buffer
+
+def run(circuit, board, engine):
 	"""Run the circuit for each input byte"""
 	if Cfg.VERBOSE > 0:
 		stderr.write('        HGFEDCBA        hgfedcba\n')
 	result = chiplib.EMPTY_RUN_RESULT
 	total_bytes = 0
 	inchar = bytes([254])
-	history = b''
+	# The input, read from stdin a block at a time or mapped from the
+	# input file; index is the next byte to be given to the circuit, and
+	# consumed is the count of bytes it has been given at least once
+	history = chiplib.History() if Cfg.INPUT is None else MappedHistory(mapInput(Cfg.INPUT))
 	index = 0
+	consumed = 0
+	# How far history may run behind index before it is trimmed
+	slack = Cfg.HISTORY_LIMIT if Cfg.HISTORY_LIMIT >= 0 else CHUNK_SIZE
+	esclen = max(map(len, Cfg.ESC_SEQS), default=0)
+	raw = Cfg.NO_BUFFER and stdin.isatty() and Cfg.INPUT is None
+	output = Output(stdout.buffer, latency=FLUSH_LATENCY if Cfg.NO_BUFFER else None)
+
+	def fill():
+		"""Add more input to history, giving False at the end of stdin"""
+		if Cfg.WITHOUT_STDIN:
+			# Generated input never blocks, but the output may be due
+			output.expire()
+			history.extend(next(Cfg.GENERATOR))
+			return True
+		if Cfg.INPUT is not None:
+			# All of the input file is already in history
+			block = b''
+		else:
+			# Reading may block, so the output so far is seen first
+			output.flush()
+			try:
+				if raw:
+					# Raw mode reads byte by byte, so each key takes effect at once
+					import termios, tty
+					orig_settings = termios.tcgetattr(stdin)
+					tty.setraw(stdin)
+					block = stdin.buffer.read(1)
+				else:
+					# read1 gives whatever is available, so a pipe is not held
+					# back waiting for a full block
+					block = stdin.buffer.read1(CHUNK_SIZE)
+			finally:
+				if raw:
+					termios.tcsetattr(stdin, termios.TCSADRAIN, orig_settings)
+		if len(block) == 0:
+			# EOF (optimization: switch to without stdin mode for future)
+			if Cfg.IGNORE_EOF:
+				Cfg.WITHOUT_STDIN = True
+				return fill()
+			return False
+		history.extend(block)
+		return True
+
 	try:
 		while True:
 			# Read input, plus eof check
@@ -273,41 +550,28 @@ def run(circuit, board):
 				if total_bytes >= Cfg.CUTOFF_BYTES > 0:
 					# we're done here
 					break
-				if index < len(history):
-					inchar = bytes([history[index]]) # need to bytes, otherwise we get an int
-				else:
-					if Cfg.WITHOUT_STDIN:
-						inchar = next(Cfg.GENERATOR)
-					else:
-						try:
-							if Cfg.NO_BUFFER and stdin.isatty():
-								orig_settings = termios.tcgetattr(stdin)
-								tty.setraw(stdin)
-							inchar = stdin.buffer.read(1)
-						finally:
-							if Cfg.NO_BUFFER and stdin.isatty():
-								termios.tcsetattr(stdin, termios.TCSADRAIN, orig_settings)
-						if len(inchar) == 0:
-							# EOF (optimization: switch to without stdin mode for future)
-							if Cfg.IGNORE_EOF:
-								inchar = next(Cfg.GENERATOR)
-								Cfg.WITHOUT_STDIN = True
-							else:
-								break
-					history += inchar
-					if history.endswith(Cfg.ESC_SEQS):
+				while index >= len(history):
+					if not fill():
+						break
+				if index >= len(history):
+					# End of stdin
+					break
+				inchar = history[index:index+1]
+				if index >= consumed:
+					consumed = index+1
+					# Only the tail of history can hold a new escape sequence
+					if esclen and history[max(0, consumed-esclen):consumed].endswith(Cfg.ESC_SEQS):
 						break
 				index += 1
 				total_bytes += 1
-			inbin = bin(ord(inchar))[2:]
-			inbits = list(map(int, '0'*(8-len(inbin)) + inbin))[::-1]
+			inbits = inchar[0]
 			if Cfg.VERBOSE > 0:
 				if not (result.statuscode & chiplib.Board.READ_HOLD):
-					if 0 <= inchar[0] < 32 or inchar[0] == 127:
+					if 0 <= inbits < 32 or inbits == 127:
 						inc = '�'
 					else:
 						inc = inchar.decode('utf-8', 'replace')
-					stderr.write('     %s\t%s  →' % (inc, ''.join(map(str, inbits[::-1]))))
+					stderr.write('     %s\t%s  →' % (inc, format(inbits, '08b')))
 				else:
 					stderr.write('                  →')
 
@@ -315,37 +579,36 @@ def run(circuit, board):
 			result = circuit.send(inbits)
 
 			# Output
-			outchar = bytes([int(''.join(map(str, result.outbits[::-1])), 2)])
+			outbyte = result.outbits
 			if Cfg.VERBOSE > 0:
 				if not (result.statuscode & chiplib.Board.WRITE_HOLD):
-					if 0 <= outchar[0] < 32 or outchar[0] == 127:
+					if 0 <= outbyte < 32 or outbyte == 127:
 						outc = '�'
 					else:
-						outc = outchar.decode('utf-8', 'replace')
-					stderr.write('  %s\t%s' % (outc, ''.join(map(str, result.outbits[::-1]))))
+						outc = bytes([outbyte]).decode('utf-8', 'replace')
+					stderr.write('  %s\t%s' % (outc, format(outbyte, '08b')))
 				else:
 					stderr.write('             ')
 				if Cfg.VERBOSE > 1:
 					if result.debug:
 						for msg in sorted(result.debug):
 							stderr.write('\n\t\t\t\t\t%s(%d,%d,%d): %s' % msg)
-					if board.storage:
-						stderr.write('\n\t\t\t\t\tStack: ' if Cfg.STORAGE[0] == 's' else '\n\t\t\t\t\tQueue: ')
-						dir = -1 if Cfg.STORAGE[0] == 's' else 1
-						if len(board.storage) < 9 or Cfg.VERBOSE > 2:
-							stderr.write(' '.join(map(lambda v:''.join(map(str, v[::-1])), board.storage[::dir])))
-						else:
-							cut = -9 if Cfg.STORAGE[0] == 's' else 8
-							stderr.write(' '.join(map(lambda v:''.join(map(str, v[::-1])), board.storage[:cut:dir])))
-							stderr.write(' ... ')
-							stderr.write(str(len(board.storage)-8))
-							stderr.write('more')
+					for unit, storage in enumerate(board.storages):
+						if storage:
+							stderr.write('\n\t\t\t\t\t%s%s: ' % (storage.name.capitalize(), ' 2' if unit else ''))
+							if len(storage) < 9 or Cfg.VERBOSE > 2:
+								stderr.write(' '.join(map(lambda v:format(v, '08b'), storage.words())))
+							else:
+								stderr.write(' '.join(map(lambda v:format(v, '08b'), storage.words(8))))
+								stderr.write(' ... ')
+								stderr.write(str(len(storage)-8))
+								stderr.write('more')
 				stderr.write('\n')
 
 			if not (result.statuscode & chiplib.Board.WRITE_HOLD):
-				stdout.buffer.write(outchar)
-				if Cfg.NO_BUFFER:
-					stdout.flush()
+				output.write(outbyte)
+			# The block is due after latency, even if no more bytes follow
+			output.expire()
 
 			# Early termination
 			if (result.statuscode & chiplib.Board.TERMINATE):
@@ -353,14 +616,19 @@ def run(circuit, board):
 
 			# Sleep
 			if (result.sleep):
+				output.flush()
 				time.sleep(result.sleep)
 
 			# Jump
-			if (result.jump is not None):
-				if result.jump >= 0:
-					index = result.jump
-				else:
-					index += result.jump
+			index = history.follow(index, engine.marks(), result.jump)
+
+			# Drop the input no jump can reach
+			if index - history.start > slack:
+				floor = history.floor(index)
+				if Cfg.HISTORY_LIMIT >= 0:
+					floor = max(floor, index-Cfg.HISTORY_LIMIT)
+				# Keep the tail that an escape sequence may still complete
+				history.keep(min(floor, consumed-esclen))
 
 		if Cfg.VERBOSE > 1:
 			if Cfg.VERBOSE > 2:
@@ -375,10 +643,322 @@ def run(circuit, board):
 			stderr.write('\n')
 	except StopIteration as e:
 		stderr.write('Execution halted\n')
+	finally:
+		output.flush()
 	if Cfg.NEWLINE:
 		stdout.buffer.write(b'\n')
 
+def tabulate(board):
+	"""Compile the circuit to a function that runs it over a chunk of
+	   input by table lookup, or None if it has too much state, may
+	   not run as it would be polled, or may hold its read"""
+	if board.isStateless():
+		# Each output byte depends only on its input byte
+		table = board.truthTable()
+		return lambda chunk: (chunk.translate(table), False)
+	try:
+		netlist = chiplib.Netlist(board)
+		if any(gate[0] == 'cache' for gate in netlist.gates):
+			# What a Cache in a loop reads depends on the order of the
+			# polls, which the netlist only follows in the usual case
+			return None
+		machine = chiplib.Machine(netlist)
+	except ValueError:
+		return None
+	if any(statuscode & chiplib.Board.READ_HOLD for statuscode in machine.status):
+		# A held read may hold forever, without needing more input, so
+		# the output must be written as it is made
+		return None
+	return machine.process
+
+def stream(process):
+	"""Run the circuit over the input a chunk at a time, through
+	   process, which gives the output for a chunk and whether the
+	   circuit terminated"""
+	remaining = Cfg.CUTOFF_BYTES if Cfg.CUTOFF_BYTES > 0 else -1
+	source = openInput()
+	try:
+		while remaining != 0:
+			size = CHUNK_SIZE if remaining < 0 else min(CHUNK_SIZE, remaining)
+			if Cfg.WITHOUT_STDIN:
+				chunk = b''.join(islice(Cfg.GENERATOR, size))
+			else:
+				# read1 gives whatever is available, so a pipe is not held
+				# back waiting for a full chunk
+				chunk = source.read1(size)
+				if len(chunk) == 0:
+					# EOF
+					if Cfg.IGNORE_EOF:
+						Cfg.WITHOUT_STDIN = True
+						continue
+					else:
+						break
+			output, terminated = process(chunk)
+			stdout.buffer.write(output)
+			if terminated:
+				break
+			if remaining > 0:
+				remaining -= len(chunk)
+	except KeyboardInterrupt as e:
+		stderr.write('\nExecution halted\n')
+	if Cfg.NEWLINE:
+		stdout.buffer.write(b'\n')
+
+def splitRecords(data):
+	"""Split the input into the records of batch mode"""
+	records = data.split(Cfg.SEPARATOR)
+	if records[-1] == b'':
+		# Ignore a trailing separator, or empty input
+		records.pop()
+	return records
+
+def batchEngine(board):
+	"""Compile the board to a Batch engine, as set by the options"""
+	generator = None
+	if Cfg.IGNORE_EOF:
+		generator = lambda: prepareGenerator(Cfg.GENERATOR_TEMPLATE)
+	engine = chiplib.Batch(chiplib.Netlist(board), lanes=Cfg.LANES, storagemode=Cfg.STORAGE, limit=Cfg.STORAGE_LIMIT,
+	                       overflow=Cfg.STORAGE_OVERFLOW, cutoff=Cfg.CUTOFF_BYTES, generator=generator)
+	if Cfg.VERBOSE > 1:
+		stderr.write(repr(engine) + '\n')
+	return engine
+
+def batch(board):
+	"""Run the circuit over each record of the input, as independent streams"""
+	records = splitRecords(openInput().read())
+	engine = batchEngine(board)
+	for output in engine.process(records):
+		stdout.buffer.write(output + Cfg.SEPARATOR)
+
+# The first byte of a reply from the server
+REPLY_OUTPUT = 0
+REPLY_ERROR = 1
+
+def frame(data):
+	"""Prefix data with its length, as sent to and from the server"""
+	return len(data).to_bytes(4, 'big') + data
+
+def specName(path):
+	"""Gives the name a circuit is served under, for the spec at path"""
+	return os.path.splitext(os.path.basename(path))[0]
+
+def serve(paths):
+	"""Serve the circuits of the specs at paths on the Unix socket
+	   Cfg.SERVE, until interrupted. Each circuit is set up once, and
+	   every message sent to it is run from the fresh state of its
+	   netlist, by a Batch engine. The messages waiting for a circuit
+	   are all run together, in one batch, while the next messages are
+	   read."""
+	import asyncio, signal, socket, threading
+
+	engines = {}
+	for path in paths:
+		name = specName(path)
+		if name in engines:
+			stderr.write("ERROR: more than one spec is named '%s'\n" % (name))
+			exit(2)
+		circuit, board, engine = setup(readSpec(path))
+		engines[name] = batchEngine(board)
+	if Cfg.STARTUP_PROFILE:
+		stderr.write(startupReport())
+
+	# A socket left by a server that has gone is replaced
+	probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		probe.connect(Cfg.SERVE)
+		stderr.write('ERROR: a server is already listening on %s\n' % (Cfg.SERVE))
+		exit(2)
+	except ConnectionRefusedError:
+		os.unlink(Cfg.SERVE)
+	except FileNotFoundError:
+		pass
+	finally:
+		probe.close()
+
+	async def readFrame(reader):
+		"""Gives the next message, or None at the end of the connection"""
+		try:
+			header = await reader.readexactly(4)
+		except asyncio.IncompleteReadError as e:
+			if e.partial:
+				raise
+			return None
+		return await reader.readexactly(int.from_bytes(header, 'big'))
+
+	def runBatch(engine, messages):
+		"""Run messages through engine in a thread, and give a future for
+		   the outputs. The thread is a daemon, so a circuit that never
+		   terminates does not keep the server from stopping."""
+		loop = asyncio.get_running_loop()
+		result = loop.create_future()
+		def settle(outputs, e):
+			if not result.done():
+				if e is None:
+					result.set_result(outputs)
+				else:
+					result.set_exception(e)
+		def target():
+			outputs, error = None, None
+			try:
+				outputs = engine.process(messages)
+			except Exception as e:
+				error = e
+			try:
+				loop.call_soon_threadsafe(settle, outputs, error)
+			except RuntimeError:
+				# The server stopped while the batch ran
+				pass
+		threading.Thread(target=target, daemon=True).start()
+		return result
+
+	async def work(engine, queue):
+		"""Run the messages for a circuit, as they come, a batch at a time"""
+		while True:
+			jobs = [await queue.get()]
+			while not queue.empty():
+				jobs.append(queue.get_nowait())
+			try:
+				outputs = await runBatch(engine, [message for message, future in jobs])
+			except Exception as e:
+				for message, future in jobs:
+					if not future.done():
+						future.set_exception(e)
+			else:
+				for (message, future), output in zip(jobs, outputs):
+					if not future.done():
+						future.set_result(output)
+
+	async def reply(writer, replies):
+		"""Send the reply to each message, in the order they were sent"""
+		while True:
+			future = await replies.get()
+			if future is None:
+				break
+			try:
+				data = bytes([REPLY_OUTPUT]) + await future
+			except Exception as e:
+				data = bytes([REPLY_ERROR]) + str(e).encode('utf-8')
+			writer.write(frame(data))
+			await writer.drain()
+
+	async def handle(reader, writer):
+		"""Read the name of a circuit, then queue each message sent for it.
+		   The replies are sent as they are ready, by another task, so
+		   reading goes on while they wait to be written."""
+		loop = asyncio.get_running_loop()
+		replies = asyncio.Queue()
+		sender = None
+		try:
+			name = await readFrame(reader)
+			if name is None:
+				return
+			name = name.decode('utf-8', 'replace')
+			if name not in engines:
+				writer.write(frame(bytes([REPLY_ERROR]) + ("no circuit is named '%s'" % (name)).encode('utf-8')))
+				await writer.drain()
+				return
+			sender = asyncio.ensure_future(reply(writer, replies))
+			while True:
+				message = await readFrame(reader)
+				if message is None:
+					break
+				future = loop.create_future()
+				queues[name].put_nowait((message, future))
+				replies.put_nowait(future)
+			replies.put_nowait(None)
+			await sender
+		except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+			# Cancelled as the server stops
+			pass
+		finally:
+			if sender is not None:
+				sender.cancel()
+			writer.close()
+
+	async def main():
+		loop = asyncio.get_running_loop()
+		for name in engines:
+			queues[name] = asyncio.Queue()
+		# The workers are kept, as the loop only holds weak references to tasks
+		workers = [asyncio.ensure_future(work(engines[name], queues[name])) for name in engines]
+		server = await asyncio.start_unix_server(handle, path=Cfg.SERVE)
+		stderr.write('Serving %s on %s\n' % (', '.join(sorted(engines)), Cfg.SERVE))
+		# Being terminated stops the server as an interrupt does
+		stop = loop.create_future()
+		loop.add_signal_handler(signal.SIGTERM, lambda: stop.done() or stop.set_result(None))
+		async with server:
+			await stop
+
+	queues = {}
+	try:
+		asyncio.run(main())
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if os.path.exists(Cfg.SERVE):
+			os.unlink(Cfg.SERVE)
+
+def connect(name):
+	"""Run the input through the circuit named name, on the server at
+	   Cfg.CONNECT, and write its output. Gives the exit status."""
+	import socket
+	data = openInput().read()
+	records = splitRecords(data) if Cfg.BATCH else [data]
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(Cfg.CONNECT)
+	except OSError as e:
+		stderr.write('ERROR: could not connect to %s: %s\n' % (Cfg.CONNECT, e.strerror))
+		return 1
+	with sock:
+		try:
+			# The server keeps reading while it replies, so every message
+			# can be sent before any reply is read
+			sock.sendall(frame(specName(name).encode('utf-8')) + b''.join(map(frame, records)))
+			sock.shutdown(socket.SHUT_WR)
+		except BrokenPipeError:
+			# The server closed the connection, and its reply says why
+			pass
+		replies = sock.makefile('rb')
+		for record in records:
+			header = replies.read(4)
+			data = replies.read(int.from_bytes(header, 'big')) if len(header) == 4 else b''
+			if len(data) == 0:
+				stderr.write('ERROR: the server closed the connection\n')
+				return 1
+			if data[0] != REPLY_OUTPUT:
+				stderr.write('ERROR: %s\n' % (data[1:].decode('utf-8', 'replace')))
+				return 1
+			stdout.buffer.write(data[1:] + (Cfg.SEPARATOR if Cfg.BATCH else b''))
+	if Cfg.NEWLINE and not Cfg.BATCH:
+		stdout.buffer.write(b'\n')
+	return 0
+
 if __name__ == '__main__':
 	spec = init()
-	circuit, board = setup(spec)
-	run(circuit, board)
+	if Cfg.CONNECT:
+		exit(connect(Cfg.SPECS[0]))
+	if Cfg.SERVE:
+		serve(Cfg.SPECS)
+		exit(0)
+	circuit, board, engine = setup(spec)
+	if Cfg.STARTUP_PROFILE:
+		stderr.write(startupReport())
+	if Cfg.BATCH:
+		batch(board)
+	else:
+		process = None
+		if Cfg.ENGINE is None and not (Cfg.VERBOSE or Cfg.NO_BUFFER or Cfg.ESC_SEQS or Cfg.PROFILE or Cfg.FLAMEGRAPH):
+			process = tabulate(board)
+		if process is not None:
+			stream(process)
+		else:
+			run(circuit, board, engine)
+	if Cfg.PROFILE:
+		import json
+		with open(Cfg.PROFILE, 'w') as f:
+			json.dump(engine.report(), f, indent='\t')
+			f.write('\n')
+	if Cfg.FLAMEGRAPH:
+		with open(Cfg.FLAMEGRAPH, 'w') as f:
+			f.write(engine.folded())
@@ -3,16 +3,18 @@
 #author Derek Anderson
 #interpreter v0.1.5
 
-import random, subprocess, sys
+import random, sys, time
+from array import array
 from collections import defaultdict, namedtuple
 
-# Determine window width
-if sys.version_info[1] >= 3: # Python 3.3+
-	import shutil
-	_terminal_size = shutil.get_terminal_size((80,20))
-	COLUMNS = int(_terminal_size.columns)
-else:
-	COLUMNS = 80
+def columns():
+	"""Determine window width. This is only asked when a board is drawn,
+	   rather than on every start."""
+	if sys.version_info[1] >= 3: # Python 3.3+
+		import shutil
+		return int(shutil.get_terminal_size((80,20)).columns)
+	else:
+		return 80
 
 oppositeDir = {
 		'n':'s',
@@ -24,7 +26,13 @@ oppositeDir = {
 	}
 
 RunResult = namedtuple('RunResult', ['statuscode', 'outbits', 'sleep', 'debug', 'jump'])
-EMPTY_RUN_RESULT = RunResult(0, [0]*8, 0, [], None)
+# The options a Board is made with
+BoardConfig = namedtuple('BoardConfig', ['STORAGE', 'STORAGE_LIMIT', 'STORAGE_OVERFLOW', 'INSTRUMENT'])
+# The version of the layers given by layoutSpec and the nets given by
+# Board.saveNets, which may be kept between runs. It must be bumped with
+# any change to either form.
+FORMAT = 2
+EMPTY_RUN_RESULT = RunResult(0, 0, 0, [], None)
 
 ###                         ###
 #   Start class definitions   #
@@ -35,17 +43,25 @@ class Board(object):
 	WRITE_HOLD = 0x2
 	TERMINATE = 0x4
 
+	# The read and write control flavors of each storage unit
+	STORAGE_CONTROLS = ('rw', 'RW')
+
 	CUR_POLL_DEPTH = 0
 
 	def __init__(self, cfg):
 		self.cboard = None
 		self.terminals = {cls:set() for cls in PRIORITYLIST}
 		self.storagemode = cfg.STORAGE
+		self.storagelimit = cfg.STORAGE_LIMIT
+		self.storageoverflow = cfg.STORAGE_OVERFLOW
+		# Whether to keep the stats, heatmap counts and debug messages,
+		# which otherwise cost nothing
+		self.instrument = cfg.INSTRUMENT
 	def __str__(self):
 		if self.initialized():
 			out = ''
 			# Find out how many frames fit in columns
-			n = (COLUMNS-2)//(self.w+1)
+			n = (columns()-2)//(self.w+1)
 			n = 1 if n == 0 else n
 			# Spread the frames evenly across rows
 			n = (self.d+n-1)//n
@@ -78,7 +94,7 @@ class Board(object):
 			header = '(' + str(maxv) + ') ' + ' '.join([color + str(int(index/scale)) for index, color in list(enumerate(ramp))[::-1]]) + reset + '\n'
 			out = header
 			# Find out how many frames fit in columns
-			n = (COLUMNS-2)//(self.w+1)
+			n = (columns()-2)//(self.w+1)
 			n = 1 if n == 0 else n
 			# Spread the frames evenly across rows
 			n = (self.d+n-1)//n
@@ -96,17 +112,23 @@ class Board(object):
 		else:
 			return ''
 
-	def initialize(self, cboard):
+	def initialize(self, cboard, nets=None):
+		"""Sets up the board from its elements. The nets may be given as
+		   described by saveNets, from an earlier board of the same spec,
+		   rather than solved again."""
 		self.cboard = cboard
 		self.d = len(cboard)
 		self.h = len(cboard[0])
 		self.w = len(cboard[0][0])
-		self.inbits = [0]*8
-		self.outbits = [0]*8
+		# The input and output bytes, the storage heads, and each word in
+		# the storage are ints, with bit 0 as the low bit
+		self.inbits = 0
+		self.outbits = 0
 		self.sleep = 0
 		self.statuscode = 0
-		self.storagectl = {'w':set(), 'r':set()}
-		self.storage = []
+		self.storagectl = {flavor:set() for flavor in ''.join(Board.STORAGE_CONTROLS)}
+		self.storages = []
+		self.storage = None
 		self.storageheadr = None
 		self.storageheadw = None
 		self.age = 0
@@ -114,54 +136,189 @@ class Board(object):
 		self.stats = defaultdict(int)
 		self.alerts = set()
 		self.jump = None
-
-		def prepareStack():
-			if self.storage:
-				# Peek at stack to read
-				self.storageheadr = self.storage[-1]
-			else:
-				# Produce zeroes to read if the stack is empty
-				self.storageheadr = [0]*8
-			# Create write head unconditionally
-			self.storageheadw = [0]*8
-		def finalizeStack():
-			if self.getStorageControl('r') and self.storage:
-				# If we were reading, not only peeking, actually pop the stack now
-				self.storage.pop()
-				self.stats['stack.pop'] += 1
-			if self.getStorageControl('w'):
-				# If we were writing, commit the write head
-				self.storage.append(self.storageheadw)
-				self.stats['stack.push'] += 1
-		def prepareQueue():
-			if self.storage:
-				# Peek at queue to read
-				self.storageheadr = self.storage[0]
-			else:
-				# Produce zeroes to read if the queue is empty
-				self.storageheadr = [0]*8
+		# The polls of Cache elements under way, which WireNets compare
+		self.caching = 0
+
+		def prepareStorage():
+			# Peek at each storage to read, the second unit on the high
+			# byte of the head; an empty one produces zeroes
+			self.storageheadr = 0
+			for unit, storage in enumerate(self.storages):
+				self.storageheadr |= storage.peek() << 8*unit
 			# Create write head unconditionally
-			self.storageheadw = [0]*8
-		def finalizeQueue():
-			if self.getStorageControl('r') and self.storage:
-				# If we were reading, not only peeking, actually pop the queue now
-				self.storage.pop(0)
-				self.stats['queue.pop'] += 1
-			if self.getStorageControl('w'):
-				# If we were writing, commit the write head
-				self.storage.append(self.storageheadw)
-				self.stats['queue.push'] += 1
-
-		if self.storagemode[0] == 's':
-			self.registerInternal(prepareStack, DummyPrepare)
-			self.registerInternal(finalizeStack, DummyFinalize)
-		elif self.storagemode[0] == 'q':
-			self.registerInternal(prepareQueue, DummyPrepare)
-			self.registerInternal(finalizeQueue, DummyFinalize)
+			self.storageheadw = 0
+		def finalizeStorage():
+			# Commit every unit at once, so that none sees another's
+			# changes until the next cycle
+			instrument = self.instrument
+			for unit, storage in enumerate(self.storages):
+				read, write = Board.STORAGE_CONTROLS[unit]
+				word = self.storageheadw >> 8*unit & 0xff
+				name = storage.name + ('2' if unit else '')
+				if storage.name == 'memory':
+					if self.getStorageControl(write):
+						# If we were writing, store the write head at the address
+						storage.write(word)
+						if instrument:
+							self.stats[name + '.write'] += 1
+					if self.getStorageControl(read):
+						# If we were reading, move to the address on the write head
+						storage.seek(word)
+						if instrument:
+							self.stats[name + '.seek'] += 1
+					continue
+				if self.getStorageControl(read) and storage:
+					# If we were reading, not only peeking, actually pop the storage now
+					storage.pop()
+					if instrument:
+						self.stats[name + '.pop'] += 1
+				if self.getStorageControl(write):
+					# If we were writing, commit the write head
+					if storage.push(word):
+						if instrument:
+							self.stats[name + '.push'] += 1
+					else:
+						if instrument:
+							self.stats[name + '.overflow'] += 1
+							self.addDebug(' ', 0, 0, 0, '[WARN] The %s is full' % (name))
+						if self.storageoverflow == 'halt':
+							self.addStatus(Board.TERMINATE)
+
+		self.storages = [makeStorage(mode, self.storagelimit, self.storageoverflow) for mode in self.storagemode or '']
+		self.storage = self.storages[0] if self.storages else None
+		if self.storages:
+			self.registerInternal(prepareStorage, DummyPrepare)
+			self.registerInternal(finalizeStorage, DummyFinalize)
+
+		if nets is None:
+			self.solveNets()
+		else:
+			self.loadNets(nets)
+		if self.instrument:
+			for layer in self.cboard:
+				for row in layer:
+					for element in row:
+						element.pollNeighbor = element.pollNeighborCounted
+						element.pollInternal = element.pollInternalCounted
 
 	def initialized(self):
 		return self.cboard is not None
 
+	def solveNets(self):
+		"""Merges the passive elements of the board (wires, pins, and the
+		   like) into WireNets, using the same descriptions as the
+		   Netlist, so that each net is polled once per cycle rather than
+		   cell by cell. A Cache is not passive, and keeps its own poll.
+		   Ports that connect both ways are joined with a union-find. Any
+		   loop through the one-way ports left over, such as diodes, then
+		   joins everything in it into a single net."""
+		descs = {}
+		for layer in self.cboard:
+			for row in layer:
+				for element in row:
+					for side in 'nsewud':
+						descs[(element, side)] = element.compilePoll(side)
+		def isWire(port):
+			return descs[port] is not None and descs[port][0] == 'wire'
+		def connection(port, dir):
+			"""Gives the port facing port[0] in dir, or None if nothing
+			   connects there."""
+			neighbor = port[0].getNeighbor(dir)
+			if neighbor is None or descs[(neighbor, oppositeDir[dir])] is None:
+				return None
+			return (neighbor, oppositeDir[dir])
+
+		# A port connects both ways when every side it reads also reads it.
+		# Ports are kept in board order, rather than in a set, as the
+		# order of a net's inputs decides which of them are polled.
+		symmetric = dict.fromkeys(port for port in descs if isWire(port) and
+		                          all(isWire((port[0], dir)) and port[1] in descs[(port[0], dir)][1] for dir in descs[port][1]))
+		parent = {port:port for port in symmetric}
+		def find(port):
+			while parent[port] != port:
+				parent[port] = parent[parent[port]]
+				port = parent[port]
+			return port
+		for port in symmetric:
+			for dir in descs[port][1]:
+				parent[find(port)] = find((port[0], dir))
+			other = connection(port, port[1])
+			if other in symmetric:
+				parent[find(port)] = find(other)
+		members = defaultdict(list)
+		vertices = defaultdict(set)
+		joins = defaultdict(int)
+		for port in symmetric:
+			root = find(port)
+			members[root].append(port)
+			vertices[root].add((port[0], frozenset(descs[port][1] + port[1])))
+			if connection(port, port[1]) in symmetric:
+				joins[root] += 1
+
+		# Then the one-way ports, with each net as a single node
+		def node(port):
+			return find(port) if port in symmetric else port
+		def reads(current):
+			"""Gives the (element, dir) pairs that a node polls."""
+			if current in members:
+				return [port for port in members[current] if connection(port, port[1]) not in symmetric]
+			return [(current[0], dir) for dir in descs[current][1]]
+		def successors(current):
+			children = []
+			for element, dir in reads(current):
+				other = connection((element, dir), dir)
+				if other is not None and isWire(other):
+					children.append(node(other))
+			return children
+		roots = list(members) + [port for port in descs if isWire(port) and port not in symmetric]
+		for component in stronglyConnected(roots, successors):
+			looped = len(component) > 1 or component[0] in successors(component[0])
+			if not looped and component[0] not in members:
+				continue
+			nodes = set(component)
+			# Each pair of sides joined within a net counts twice
+			cyclic = looped or joins[component[0]] // 2 >= len(vertices[component[0]])
+			net = WireNet(self, cyclic)
+			for member in component:
+				for element, dir in reads(member):
+					other = connection((element, dir), dir)
+					if other is not None and node(other) not in nodes and (element, dir) not in net.inputs:
+						net.inputs.append((element, dir))
+				for element, side in (members[member] if member in members else [member]):
+					self.joinNet(element, side, net)
+
+	def joinNet(self, element, side, net):
+		if not hasattr(element, 'nets'):
+			element.nets = {}
+			element.poll = element.pollNet
+		element.nets[side] = net
+
+	def saveNets(self):
+		"""Describes the WireNets of the board compactly, for loadNets,
+		   in the version of FORMAT. Each net is given as its cyclic flag, then its inputs, and the
+		   ports that are part of it, each as an array of port numbers,
+		   in bytes. A port is numbered by its element's place in the
+		   board, times six, plus its side's place in 'nsewud'."""
+		nets = {}
+		for layer in self.cboard:
+			for row in layer:
+				for element in row:
+					for side, net in getattr(element, 'nets', {}).items():
+						if net not in nets:
+							nets[net] = (net.cyclic, array('q', (self.portNumber(*input) for input in net.inputs)), array('q'))
+						nets[net][2].append(self.portNumber(element, side))
+		return [(cyclic, inputs.tobytes(), ports.tobytes()) for cyclic, inputs, ports in nets.values()]
+	def loadNets(self, nets):
+		"""Joins the elements into the WireNets described by saveNets."""
+		cells = [element for layer in self.cboard for row in layer for element in row]
+		for cyclic, inputs, ports in nets:
+			net = WireNet(self, cyclic)
+			net.inputs = [(cells[port // 6], 'nsewud'[port % 6]) for port in array('q', inputs)]
+			for port in array('q', ports):
+				self.joinNet(cells[port // 6], 'nsewud'[port % 6], net)
+	def portNumber(self, element, side):
+		return (((element.z * self.h) + element.y) * self.w + element.x) * 6 + 'nsewud'.index(side)
+
 	def registerInternal(self, element, cls=None):
 		if cls is None:
 			cls = type(element)
@@ -176,33 +333,67 @@ class Board(object):
 			return None
 
 	def run(self, inbits):
+		self.beginCycle(inbits)
+
+		for cls in PRIORITYLIST:
+			for element in self.terminals[cls]:
+				element()
+
+		return self.endCycle()
+
+	def beginCycle(self, inbits):
+		"""Resets the per-cycle state, and advances the age. Shared by
+		   every engine that runs this board."""
 		self.debug = []
 		self.inbits = inbits
-		self.outbits = [0]*8
+		self.outbits = 0
 		self.sleep = 0
 		self.statuscode = 0
-		self.storagectl['w'].clear()
-		self.storagectl['r'].clear()
+		for controls in self.storagectl.values():
+			controls.clear()
 		self.storageheadr = None
 		self.storageheadw = None
 		self.jump = None
 
 		self.age += 1
-
-		for cls in PRIORITYLIST:
-			for element in self.terminals[cls]:
-				element()
-
+	def endCycle(self):
 		return RunResult(statuscode=self.statuscode,
 		                 outbits=self.outbits,
 		                 sleep=self.sleep,
 		                 debug=self.debug,
 		                 jump=self.jump)
 
+	def isStateless(self):
+		"""True if each output byte depends only on the input byte of
+		   the same cycle, in which case the board is a truth table. A
+		   Cache counts as state, as in a loop it keeps a value from
+		   one cycle to the next."""
+		stateful = (Bookmark, Cache, Control, Delay, Memory, Pause, Pulse,
+		            Random, Sleep, StorageBit, StorageControl)
+		if self.instrument:
+			stateful += (Debug,)
+		return not any(isinstance(element, stateful) for layer in self.cboard for row in layer for element in row)
+	def truthTable(self):
+		"""Runs the board once for every input byte, and gives the
+		   outputs as a table for bytes.translate. Only meaningful if
+		   the board is stateless."""
+		age = self.age
+		table = bytearray(256)
+		for value in range(256):
+			table[value] = self.run(value).outbits
+		self.age = age
+		return bytes(table)
+
+	def marks(self):
+		"""Gives the ages at which the bookmarks still waiting to
+		   recall were marked. Any jump goes back no further than the
+		   earliest of these."""
+		return [element.mark for element in self.terminals[Bookmark] if element.mark is not None]
+
 	def readBit(self, index):
-		return self.inbits[index]
+		return self.inbits >> index & 1
 	def writeBit(self, index, value):
-		self.outbits[index] |= value
+		self.outbits |= value << index
 
 	def addStatus(self, statuscode):
 		self.statuscode |= statuscode
@@ -219,8 +410,9 @@ class Board(object):
 			# prioritize small (2) to large (5) positive,
 			# then large (-5) to small (-2) negative
 			# (zero condsidered positive)
-			self.addDebug(' ', 0, 0, 0, '[WARN] Multiple jumps were attempted')
-			self.stats['jump.multi'] += 1
+			if self.instrument:
+				self.addDebug(' ', 0, 0, 0, '[WARN] Multiple jumps were attempted')
+				self.stats['jump.multi'] += 1
 			if jump >= 0:
 				if self.jump >= 0:
 					self.jump = min(self.jump, jump)
@@ -231,13 +423,14 @@ class Board(object):
 					pass
 				else:
 					self.jump = min(self.jump, jump)
-		self.addDebug(' ', 0, 0, 0, 'Setting jump to %d' % (self.jump,))
+		if self.instrument:
+			self.addDebug(' ', 0, 0, 0, 'Setting jump to %d' % (self.jump,))
 
 	def checkStatus(self, statuscode):
 		return self.statuscode & statuscode
 
 	def setStorageControl(self, control, controlFlavor, controlValue):
-		"""The two storage controls -- read and write -- are each lists.
+		"""The storage controls -- read and write, for each unit -- are each lists.
 		   When the control is set, the setting element is added to
 		   the list, when cleared it is removed. If the list has any
 		   values, its control is considered active."""
@@ -249,14 +442,23 @@ class Board(object):
 			assert 1 == 0, "'%d' is not a valid storage control value" % (controlValue)
 	def getStorageControl(self, controlFlavor):
 		return 1 if self.storagectl[controlFlavor] else 0
+	def usesWriteHead(self, unit=0):
+		"""True if the write head of the storage unit is used this cycle:
+		   when writing, and in memory mode, also when moving to a new
+		   address."""
+		read, write = Board.STORAGE_CONTROLS[unit]
+		return self.getStorageControl(write) or (self.storagemode[unit:unit+1] == 'm' and self.getStorageControl(read))
 
 	def readStorageBit(self, index):
-		return self.storageheadr[index]
+		return self.storageheadr >> index & 1
 	def writeStorageBit(self, index, value):
-		self.storageheadw[index] |= value
+		self.storageheadw |= value << index
 
 class Element(object):
 	lexemes = {}
+	# The sides whose poll may give a new value once pollInternal has
+	# run, which the memo engine must then poll again
+	volatile = ''
 
 	def __init__(self, board, x, y, z, lexeme):
 		self.board = board
@@ -270,14 +472,7 @@ class Element(object):
 	def __repr__(self):
 		return self.__class__.__name__ + '(' + self.__str__() + ')'
 	def __call__(self):
-		#self.addDebug('Performing internal poll')
-		retval = self.pollInternal()
-		self.calls += 1
-		self.board.stats['poll.internal'] += 1
-		if 'overflow' in self.board.alerts:
-			self.addDebug('Stack overflow started here')
-			self.board.alerts.discard('overflow')
-		return retval
+		return self.pollInternal()
 
 	@classmethod
 	def getValidLexemes(cls):
@@ -332,11 +527,51 @@ class Element(object):
 		   by elements that need to run every cycle, but may not be
 		   polled conventionally."""
 		pass
+	def pollInternalCounted(self):
+		"""Replaces pollInternal when the board is instrumented."""
+		#self.addDebug('Performing internal poll')
+		retval = self.__class__.pollInternal(self)
+		self.calls += 1
+		self.board.stats['poll.internal'] += 1
+		if 'overflow' in self.board.alerts:
+			self.addDebug('Stack overflow started here')
+			self.board.alerts.discard('overflow')
+		return retval
+	def compilePoll(self, side):
+		"""Describes poll(side) for the Netlist compiler, and must be
+		   kept in agreement with it. Gives None for no connection,
+		   ('wire', dirs) when the value is the or of the neighbors in
+		   dirs, ('cache', dirs) when it is that or, but each neighbor
+		   is polled once per cycle, or a tuple describing a gate or
+		   state cell."""
+		return None
+	def compileInternal(self):
+		"""Describes pollInternal for the Netlist compiler, in the same
+		   manner as compilePoll."""
+		return None
+	def pollNet(self, side):
+		"""Replaces poll for elements that are part of a WireNet."""
+		if side in self.nets:
+			return self.nets[side].poll(self, side)
+		return self.__class__.poll(self, side)
 	def pollNeighbor(self, dir):
 		"""Should not be overridden in most circumstances. Used to poll
 		   a neighboring element. Enforces a soft recursion limit, and
 		   handles board edges."""
 		neighbor = self.getNeighbor(dir)
+		if neighbor is not None:
+			try:
+				value = neighbor.poll(oppositeDir[dir])
+			except RecursionError:
+				# Soft recursion limit reached
+				return 0
+			return 0 if value is None else value
+		else:
+			# Edge of board
+			return 0
+	def pollNeighborCounted(self, dir):
+		"""Replaces pollNeighbor when the board is instrumented."""
+		neighbor = self.getNeighbor(dir)
 		if neighbor is not None:
 			self.board.stats['poll.neighbor'] += 1
 			try:
@@ -390,6 +625,14 @@ class Adder(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side == self.flavor[0]:
+			return ('xor', 'n', self.flavor[1])
+		elif side == 's':
+			return ('and', 'n', self.flavor[1])
+		else:
+			return None
+
 class And(Element):
 	lexemes = {']':('ew',']'), '[':('we','[')}
 
@@ -416,6 +659,16 @@ class And(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side == self.flavor[0]:
+			return ('and', 'ns', self.flavor[1])
+		elif side == 'n':
+			return ('wire', 's')
+		elif side == 's':
+			return ('wire', 'n')
+		else:
+			return None
+
 class Bookmark(Element):
 	lexemes = 'V'
 
@@ -443,6 +696,9 @@ class Bookmark(Element):
 				self.mark = None
 				self.board.setJump(-distance)
 
+	def compileInternal(self):
+		return ('bookmark', 'nswe')
+
 class Cache(Element):
 	lexemes = {'K':(lambda s:[x for x in 'nsew' if x != s], 'K'),
 	           'k':(lambda s:[oppositeDir[s]] if s in 'nsew' else [], 'k')}
@@ -463,18 +719,29 @@ class Cache(Element):
 	def poll(self, side):
 		if side in 'nsew':
 			outValue = 0
-			for dir in self.flavor(side):
-				if self.inAges[dir] != self.board.age:
-					self.inAges[dir] = self.board.age
-					self.inValues[dir] = self.pollNeighbor(dir)
-					self.board.stats['cache.miss'] += 1
-				else:
-					self.board.stats['cache.hit'] += 1
-				outValue = outValue or self.inValues[dir]
+			self.board.caching += 1
+			try:
+				for dir in self.flavor(side):
+					if self.inAges[dir] != self.board.age:
+						self.inAges[dir] = self.board.age
+						self.inValues[dir] = self.pollNeighbor(dir)
+						if self.board.instrument:
+							self.board.stats['cache.miss'] += 1
+					elif self.board.instrument:
+						self.board.stats['cache.hit'] += 1
+					outValue = outValue or self.inValues[dir]
+			finally:
+				self.board.caching -= 1
 			return outValue
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side in 'nsew':
+			return ('cache', ''.join(self.flavor(side)))
+		else:
+			return None
+
 class Control(Element):
 	lexemes = 'TtSs'
 
@@ -504,12 +771,18 @@ class Control(Element):
 				elif self.lexeme == 's':
 					self.board.addStatus(Board.READ_HOLD)
 
+	def compileInternal(self):
+		return ('control', self.lexeme, 'nswe')
+
 class Debug(Element):
 	lexemes = 'X'
 
 	def __init__(self, board, x, y, z, lexeme):
 		Element.__init__(self, board, x, y, z, self.lexemes[0])
-		board.registerInternal(self)
+		# The messages are only kept by an instrumented board, so
+		# otherwise there is nothing to run
+		if board.instrument:
+			board.registerInternal(self)
 
 	def pollInternal(self):
 		value = self.pollNeighbor('n') or\
@@ -518,6 +791,9 @@ class Debug(Element):
 		        self.pollNeighbor('e')
 		self.addDebug(value)
 
+	def compileInternal(self):
+		return ('debug', 'nswe')
+
 class Delay(Element):
 	lexemes = {'Z':('ew','Z'), 'z':('we','z')}
 
@@ -527,6 +803,7 @@ class Delay(Element):
 		self.age = 0
 		self.currValue = 0
 		self.nextValue = 0
+		self.volatile = 's' + self.flavor[0]
 		board.registerInternal(self)
 
 	@classmethod
@@ -551,6 +828,15 @@ class Delay(Element):
 		else:
 			return None
 
+	def compileInternal(self):
+		return ('delay', 'n' + self.flavor[1])
+
+	def compilePoll(self, side):
+		if side in ['s', self.flavor[0]]:
+			return ('delay',)
+		else:
+			return None
+
 class Diode(Element):
 	lexemes = {'→':('we','→'), '←':('ew','←'), '↓':('ns','↓'), '↑':('sn','↑')}
 
@@ -571,6 +857,12 @@ class Diode(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side == self.flavor[1]:
+			return ('wire', self.flavor[0])
+		else:
+			return None
+
 class Empty(Element):
 	lexemes = ' '
 
@@ -590,6 +882,12 @@ class InBit(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side in 'nswe':
+			return ('input', self.index)
+		else:
+			return None
+
 class Memory(Element):
 	lexemes = {'M':('ew','M'), 'm':('we','m')}
 
@@ -597,6 +895,7 @@ class Memory(Element):
 		self.flavor, lex = self.__class__.getFlavor(lexeme)
 		Element.__init__(self, board, x, y, z, lex)
 		self.currValue = 0
+		self.volatile = self.flavor[0]
 		board.registerInternal(self)
 
 	@classmethod
@@ -621,6 +920,19 @@ class Memory(Element):
 		else:
 			return None
 
+	def compileInternal(self):
+		return ('memory', 'ns', self.flavor[1])
+
+	def compilePoll(self, side):
+		if side == self.flavor[0]:
+			return self.compileInternal()
+		elif side == 'n':
+			return ('wire', 's')
+		elif side == 's':
+			return ('wire', 'n')
+		else:
+			return None
+
 class Not(Element):
 	lexemes = {'⌐~':('ew','⌐'), '¬÷':('we','¬')}
 
@@ -642,6 +954,12 @@ class Not(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side == self.flavor[0]:
+			return ('not', self.flavor[1])
+		else:
+			return None
+
 class Or(Element):
 	lexemes = {')':('ew',')'), '(':('we','(')}
 
@@ -668,6 +986,16 @@ class Or(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side == self.flavor[0]:
+			return ('or', 'ns', self.flavor[1])
+		elif side == 'n':
+			return ('wire', 's')
+		elif side == 's':
+			return ('wire', 'n')
+		else:
+			return None
+
 class OutBit(Element):
 	lexemes = 'abcdefgh'
 
@@ -686,6 +1014,9 @@ class OutBit(Element):
 		        self.pollNeighbor('e')
 		self.board.writeBit(self.index, value)
 
+	def compileInternal(self):
+		return ('output', self.index, 'nswe')
+
 class Pause(Element):
 	# pause for muliples of 1 sec, or of 1/256ths of a sec
 	lexemes = {'P':(1,'P'), 'p':(1/256,'p')}
@@ -707,10 +1038,10 @@ class Pause(Element):
 		   self.pollNeighbor('s') or\
 		   self.pollNeighbor('w') or\
 		   self.pollNeighbor('e'):
-			storage_peek = 0
-			for bit in self.board.storageheadr[::-1]:
-				storage_peek = (storage_peek << 1) | bit
-			self.board.addSleep(storage_peek * self.scale)
+			self.board.addSleep((self.board.storageheadr & 0xff) * self.scale)
+
+	def compileInternal(self):
+		return ('pause', self.scale, 'nswe')
 
 class Pin(Element):
 	lexemes = 'Oo'
@@ -747,6 +1078,18 @@ class Pin(Element):
 					value = value or self.pollNeighbor(s)
 		return value
 
+	def compilePoll(self, side):
+		dirs = ''
+		for s in 'ud':
+			if s != side:
+				if self.neighborType(s) != self.__class__ or self.getNeighbor(s).lexeme == self.lexeme:
+					dirs += s
+		for s in 'nswe':
+			if s != side:
+				if self.neighborType(s) != self.__class__ or self.getNeighbor(s).lexeme != self.lexeme:
+					dirs += s
+		return ('wire', dirs)
+
 class Pulse(Element):
 	lexemes = '!'
 
@@ -763,6 +1106,12 @@ class Pulse(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side in 'nswe':
+			return ('pulse',)
+		else:
+			return None
+
 class Random(Element):
 	lexemes = '?'
 
@@ -780,6 +1129,12 @@ class Random(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side in 'nswe':
+			return ('random',)
+		else:
+			return None
+
 class Sleep(Element):
 	# sleep for 1/10, 1/4, 1/2, or 1 sec.
 	lexemes = '$'
@@ -796,6 +1151,9 @@ class Sleep(Element):
 		      self.pollNeighbor('e')
 		self.board.addSleep(self.sleep_ramp[idx])
 
+	def compileInternal(self):
+		return ('sleep', 'nswe')
+
 class Source(Element):
 	lexemes = '*'
 
@@ -808,8 +1166,15 @@ class Source(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side in 'nswe':
+			return ('source',)
+		else:
+			return None
+
 class StorageBit(Element):
-	lexemes = '01234567'
+	# The bits of the first storage unit, then those of the second
+	lexemes = '01234567⓪①②③④⑤⑥⑦'
 
 	def __init__(self, board, x, y, z, lexeme):
 		Element.__init__(self, board, x, y, z, lexeme)
@@ -817,7 +1182,7 @@ class StorageBit(Element):
 		board.registerInternal(self)
 
 	def pollInternal(self):
-		if self.board.getStorageControl('w'): # this condition is unnecessary, but is for optimization
+		if self.board.usesWriteHead(self.index // 8): # this condition is unnecessary, but is for optimization
 			value = (0 if self.neighborType('n') == self.__class__ else self.pollNeighbor('n')) or\
 			        (0 if self.neighborType('s') == self.__class__ else self.pollNeighbor('s')) or\
 			        (0 if self.neighborType('w') == self.__class__ else self.pollNeighbor('w')) or\
@@ -831,8 +1196,17 @@ class StorageBit(Element):
 		else:
 			return None
 
+	def compileInternal(self):
+		return ('storagewrite', self.index, ''.join(dir for dir in 'nswe' if self.neighborType(dir) != self.__class__))
+
+	def compilePoll(self, side):
+		if side in 'nswe':
+			return ('storage', self.index)
+		else:
+			return None
+
 class StorageControl(Element):
-	lexemes = {'9':('w','9'), '8':('r','8')}
+	lexemes = {'9':('w','9'), '8':('r','8'), '⑨':('W','⑨'), '⑧':('R','⑧')}
 
 	def __init__(self, board, x, y, z, lexeme):
 		self.flavor, lex = self.__class__.getFlavor(lexeme)
@@ -853,6 +1227,9 @@ class StorageControl(Element):
 		        self.pollNeighbor('e')
 		self.board.setStorageControl(self, self.flavor, value)
 
+	def compileInternal(self):
+		return ('storagecontrol', self.flavor, 'nswe')
+
 class Switch(Element):
 	lexemes = {'/':(1,'/'), '\\':(0,'\\')}
 
@@ -889,6 +1266,16 @@ class Switch(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side == 'n':
+			return ('wire', 's')
+		elif side == 's':
+			return ('wire', 'n')
+		elif side in 'we':
+			return ('switch', self.flavor, 'ns', oppositeDir[side])
+		else:
+			return None
+
 class Wire(Element):
 	lexemes = {'+┼':('nswe','┼'), '|│':('ns','│'), '-─':('ew','─'),
 	           '^┴':('nwe','┴'), 'v┬':('swe','┬'), '>├':('nse','├'), '<┤':('nsw','┤'),
@@ -918,6 +1305,12 @@ class Wire(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side in self.flavor:
+			return ('wire', ''.join(dir for dir in self.flavor if dir != side))
+		else:
+			return None
+
 class WireSpecial(Element):
 	lexemes = {'×x': ('nsew','×'), '«L':('nwse','«'), '»R':('nesw','»')}
 
@@ -939,6 +1332,12 @@ class WireSpecial(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side in self.flavor:
+			return ('wire', self.flavor[self.flavor.index(side) ^ 1])
+		else:
+			return None
+
 class Xor(Element):
 	lexemes = {'}':('ew','}'), '{':('we','{')}
 
@@ -965,10 +1364,245 @@ class Xor(Element):
 		else:
 			return None
 
+	def compilePoll(self, side):
+		if side == self.flavor[0]:
+			return ('xor', 'ns', self.flavor[1])
+		elif side == 'n':
+			return ('wire', 's')
+		elif side == 's':
+			return ('wire', 'n')
+		else:
+			return None
+
+
 ###                     ###
 #   End Element classes   #
 ###                     ###
 
+class WireNet(object):
+	"""A set of passive ports that all carry the same value, the or of
+	   whatever drives the net from outside, so it is polled once per
+	   cycle. While it is being polled, the net reads low, unless it is
+	   polled again through a Cache, in which case it is polled anew,
+	   as the wires would be, and the Cache ends the loop. In a net
+	   without a loop, a port does not read back its own drive, just as
+	   a poll never turns back the way it came."""
+
+	def __init__(self, board, cyclic):
+		self.board = board
+		self.cyclic = cyclic
+		self.inputs = []
+		self.age = -1
+		self.value = 0
+		# The board's caching count when the net was last entered, or
+		# None while it is not being polled
+		self.entry = None
+		self.orders = {}
+
+	def sources(self, element, side):
+		"""Gives the inputs that a poll of element from side reads."""
+		if self.cyclic or (element, side) not in self.inputs:
+			return self.inputs
+		return [input for input in self.inputs if input != (element, side)]
+
+	def poll(self, element, side):
+		if not self.cyclic and (element, side) in self.inputs:
+			value = 0
+			for input in self.sources(element, side):
+				value = value or input[0].pollNeighbor(input[1])
+				if value:
+					break
+			return value
+		if self.age != self.board.age:
+			self.age = self.board.age
+			self.value = 0
+			if self.board.instrument:
+				self.board.stats['poll.net'] += 1
+			self.value = self.pollInputs(element, side)
+		elif self.entry is not None and self.board.caching > self.entry:
+			return self.pollInputs(element, side)
+		return self.value
+
+	def order(self, element, side):
+		"""Gives the inputs in the order that the wires of the net, polled
+		   from element's side, would reach them: depth first, each wire
+		   polling its sides in turn. As the first high input ends a
+		   poll, the order decides which inputs, such as a Cache, are
+		   polled at all."""
+		if (element, side) not in self.orders:
+			inputs = set(self.inputs)
+			order = {}
+			seen = set()
+			# Each entry is a port of the net to follow, or an input
+			stack = [(True, (element, side))]
+			while stack:
+				member, port = stack.pop()
+				if not member:
+					order[port] = None
+					continue
+				if port in seen:
+					continue
+				seen.add(port)
+				following = []
+				for dir in port[0].compilePoll(port[1])[1]:
+					neighbor = port[0].getNeighbor(dir)
+					if neighbor is not None and getattr(neighbor, 'nets', {}).get(oppositeDir[dir]) is self:
+						following.append((True, (neighbor, oppositeDir[dir])))
+					elif (port[0], dir) in inputs and (port[0], dir) not in order:
+						following.append((False, (port[0], dir)))
+				stack.extend(reversed(following))
+			self.orders[(element, side)] = list(order) + [input for input in self.inputs if input not in order]
+		return self.orders[(element, side)]
+
+	def pollInputs(self, element, side):
+		entry = self.entry
+		self.entry = self.board.caching
+		try:
+			value = 0
+			for element, dir in self.order(element, side):
+				value = value or element.pollNeighbor(dir)
+				if value:
+					break
+		finally:
+			self.entry = entry
+		return value
+
+class Stack(object):
+	"""Storage words kept in a bytearray, one byte each, and read and
+	   written at the top. If limit is given, pushing onto a full stack
+	   is handled by the overflow policy: 'drop' and 'halt' do not write
+	   the word, 'oldest' drops the word at the bottom, and 'spill' moves
+	   the bottom half of the stack out to a temporary file, reading it
+	   back once the rest has been popped."""
+	name = 'stack'
+
+	def __init__(self, limit=None, overflow='drop'):
+		self.data = bytearray()
+		self.limit = limit
+		self.overflow = overflow
+		self.spill = None
+		self.spilled = 0
+	def __len__(self):
+		return len(self.data) + self.spilled
+
+	def peek(self):
+		return self.data[-1] if self.data else 0
+	def pop(self):
+		self.data.pop()
+		if not self.data and self.spilled:
+			# Read back the top of what was spilled
+			count = min(self.spilled, max(self.limit//2, 1))
+			self.spilled -= count
+			self.spill.seek(self.spilled)
+			self.data += self.spill.read(count)
+	def push(self, word):
+		"""Gives False if the word could not be written."""
+		if self.limit is not None and len(self.data) >= self.limit:
+			if self.overflow == 'oldest':
+				del self.data[:1]
+			elif self.overflow == 'spill':
+				if self.spill is None:
+					import tempfile # Only needed once a stack spills
+					self.spill = tempfile.TemporaryFile()
+				count = max(len(self.data)//2, 1)
+				self.spill.seek(self.spilled)
+				self.spill.write(self.data[:count])
+				self.spilled += count
+				del self.data[:count]
+			else:
+				return False
+		self.data.append(word)
+		return True
+
+	def words(self, count=None):
+		"""Gives the words in the order they would be read, up to count."""
+		words = self.data[::-1]
+		if self.spilled and (count is None or count > len(words)):
+			self.spill.seek(0)
+			words += self.spill.read(self.spilled)[::-1]
+		return list(words[:count])
+
+class Queue(object):
+	"""Storage words kept in a bytearray, one byte each, written at the
+	   back and read from the front. Popped words are only removed once
+	   they make up half of the array, so each pop is O(1). If limit is
+	   given, pushing onto a full queue is handled by the overflow policy,
+	   as for Stack, except that 'spill' is not supported."""
+	name = 'queue'
+
+	def __init__(self, limit=None, overflow='drop'):
+		if overflow == 'spill':
+			raise ValueError('Only a stack can spill to a file')
+		self.data = bytearray()
+		self.head = 0
+		self.limit = limit
+		self.overflow = overflow
+	def __len__(self):
+		return len(self.data) - self.head
+
+	def peek(self):
+		return self.data[self.head] if self.head < len(self.data) else 0
+	def pop(self):
+		self.head += 1
+		if self.head*2 >= len(self.data):
+			del self.data[:self.head]
+			self.head = 0
+	def push(self, word):
+		"""Gives False if the word could not be written."""
+		if self.limit is not None and len(self) >= self.limit:
+			if self.overflow == 'oldest':
+				self.pop()
+			else:
+				return False
+		self.data.append(word)
+		return True
+
+	def words(self, count=None):
+		"""Gives the words in the order they would be read, up to count."""
+		end = len(self.data) if count is None else min(self.head + count, len(self.data))
+		return list(self.data[self.head:end])
+
+class Addressed(object):
+	"""Storage of 256 words in a preallocated bytearray, read and
+	   written at an address. Writing stores the write head at the
+	   address, and reading moves to the address on the write head, so
+	   that the next cycle reads the word there. Any word can be reached
+	   in a single cycle."""
+	name = 'memory'
+
+	def __init__(self):
+		self.data = bytearray(256)
+		self.address = 0
+	def __len__(self):
+		return len(self.data)
+
+	def peek(self):
+		return self.data[self.address]
+	def write(self, word):
+		self.data[self.address] = word
+	def seek(self, address):
+		self.address = address
+
+	def words(self, count=None):
+		"""Gives the words from the address on, wrapping around, up to count."""
+		return list((self.data[self.address:] + self.data[:self.address])[:count])
+
+# The modes of a storage unit, and what may happen to a write to full storage
+STORAGE_MODES = ('m', 'q', 's')
+STORAGE_OVERFLOWS = ('drop', 'oldest', 'halt', 'spill')
+
+def makeStorage(mode, limit=None, overflow='drop'):
+	"""Gives new, empty storage for mode: a Stack for 's', a Queue for
+	   'q', or Addressed memory for 'm', which has a fixed size, and so
+	   ignores limit and overflow."""
+	if mode[0] == 's':
+		return Stack(limit, overflow)
+	elif mode[0] == 'q':
+		return Queue(limit, overflow)
+	elif mode[0] == 'm':
+		return Addressed()
+	return None
+
 class DummyPrepare(object):
 	pass
 class DummyFinalize(object):
@@ -987,18 +1621,34 @@ PRIORITYLIST = [DummyPrepare,
 		Debug,
 		DummyFinalize]
 
-# Generate the set of all subclasses of Element
-classes = set()
-module = sys.modules[__name__]
-for itemName in dir(module):
-	item = getattr(module, itemName)
-	try:
-		if issubclass(item, Element) and item is not Element:
-			classes.add(item)
-		else:
-			pass
-	except TypeError: # item isn't a class
-		pass
+# All of the element types. A new subclass of Element must be added
+# here for its lexemes to be recognized.
+classes = (Adder,
+		And,
+		Bookmark,
+		Cache,
+		Control,
+		Debug,
+		Delay,
+		Diode,
+		Empty,
+		InBit,
+		Memory,
+		Not,
+		Or,
+		OutBit,
+		Pause,
+		Pin,
+		Pulse,
+		Random,
+		Sleep,
+		Source,
+		StorageBit,
+		StorageControl,
+		Switch,
+		Wire,
+		WireSpecial,
+		Xor)
 
 # Generate the 1-to-1 mapping of lexeme -> element type
 lexmap = {}
@@ -1025,6 +1675,1780 @@ def getElementType(lexeme):
 	except KeyError:
 		raise KeyError("'%s' is not a valid lexeme" % (lexeme))
 
+LEXEMES = frozenset(lexmap)
+
+def checkChars(code, row, col, warnings):
+	"""Blank out each invalid character in a run of code, starting at
+	   (row, col), adding a warning for each to warnings"""
+	chars = list(code)
+	for i, char in enumerate(chars):
+		if char not in LEXEMES:
+			if char == '=':
+				msg = "'=' must only be found at the beginning of a line, or in a comment"
+			elif char == ';':
+				msg = "';' must only be used to terminate a block comment, or found within a layer comment"
+			else:
+				msg = "'%s' (%d) is not a valid character" % (char, ord(char))
+			warnings.append("%d:%d WARN: %s\n" % (row, col+i, msg))
+			chars[i] = ' '
+	return ''.join(chars)
+
+def cleanSpec(ospec, warnings):
+	"""Strip the comments from the text specification, and give its
+	   lines, without trailing space, or the blank lines before a layer
+	   break or at the end. Each line is split at the comment marks, so
+	   only a run of code holding an invalid character is looked at
+	   character by character."""
+	lines = []
+	blockcomment = False
+	for row, line in enumerate(ospec.split('\n'), 1):
+		if line[:1] == '=':
+			# A layer comment, which may still end a block comment
+			if blockcomment and ';' in line:
+				blockcomment = False
+			lines.append('=')
+			continue
+		out = []
+		pos = 0
+		while pos < len(line):
+			if blockcomment:
+				end = line.find(';', pos)
+				if end < 0:
+					break
+				out.append(' '*(end+1-pos))
+				blockcomment = False
+			else:
+				end = line.find(':', pos)
+				if end < 0:
+					end = len(line)
+				code = line[pos:end]
+				if not LEXEMES.issuperset(code):
+					code = checkChars(code, row, pos+1, warnings)
+				out.append(code)
+				if end < len(line):
+					out.append(' ')
+					blockcomment = True
+			pos = end+1
+		lines.append(''.join(out).rstrip())
+	# Cleanup unnecessary lines
+	spec = []
+	layertail = True
+	for line in reversed(lines):
+		if line == '':
+			if layertail:
+				continue
+		else:
+			layertail = line == '='
+		spec.append(line)
+	spec.reverse()
+	if len(spec) > 0 and spec[0] == '=':
+		spec = spec[1:]
+	return spec
+
+def stripShebang(ospec):
+	"""Gives the text specification without its first line, if that
+	   is a shebang (#!)"""
+	if ospec.startswith('#!'):
+		# Its a shebang, probably. Remove the whole line.
+		return ospec.partition('\n')[2]
+	return ospec
+
+def layoutSpec(ospec, warnings):
+	"""Gives the layers of the text specification, each a list of rows,
+	   all padded to the same size"""
+	spec = '\n'.join(cleanSpec(ospec, warnings))
+
+	# Convert to final layout
+	spec2 = list(map(lambda s: s[(1 if len(s) > 0 and s[0] == '\n' else None):].rstrip('\n'), spec.split('=')))
+	n = max(map(lambda s:s.count('\n'), spec2))
+	spec2 = list(map(lambda s:(s+('\n'*(n-s.count('\n')))).split('\n'), spec2))
+	n = max(map(lambda s:max(map(len, s)), spec2))
+	return list(map(lambda s:list(map(lambda t:t+(' '*(n-len(t))), s)), spec2))
+
+###                    ###
+#   Begin Engine classes   #
+###                    ###
+
+def stronglyConnected(roots, successors):
+	"""Iterative form of Tarjan's algorithm. Yields each strongly
+	   connected component reachable from roots as a list, and only
+	   after every component that it can reach has been yielded."""
+	index = {}
+	lowlink = {}
+	stack = []
+	onstack = set()
+	for root in roots:
+		if root in index:
+			continue
+		index[root] = lowlink[root] = len(index)
+		stack.append(root)
+		onstack.add(root)
+		work = [(root, iter(successors(root)))]
+		while work:
+			node, children = work[-1]
+			for child in children:
+				if child not in index:
+					index[child] = lowlink[child] = len(index)
+					stack.append(child)
+					onstack.add(child)
+					work.append((child, iter(successors(child))))
+					break
+				elif child in onstack:
+					lowlink[node] = min(lowlink[node], index[child])
+			else:
+				work.pop()
+				if work:
+					parent = work[-1][0]
+					lowlink[parent] = min(lowlink[parent], lowlink[node])
+				if lowlink[node] == index[node]:
+					component = []
+					while True:
+						member = stack.pop()
+						onstack.discard(member)
+						component.append(member)
+						if member == node:
+							break
+					yield component
+
+class Iterative(object):
+	"""Runs a Board by polling through an explicit stack of (element,
+	   side) frames, rather than the Python call stack, so that signal
+	   paths of any depth can be followed. Each port is evaluated at most
+	   once per cycle, from the compilePoll descriptions, and a port polled
+	   again while it is still being evaluated reads low, or for a
+	   Cache, the values it last cached. The state is
+	   kept in the elements, as with the poll engine. The deepest stack
+	   reached is kept in the poll.depth stat."""
+
+	def __init__(self, board):
+		self.board = board
+		self.ports = {}
+		self.nodes = {}
+		self.values = {}
+		self.depth = 0
+		self.internals = {}
+		for cls in PRIORITYLIST:
+			for element in board.terminals[cls]:
+				if isinstance(element, Element):
+					desc = element.compileInternal()
+					if desc[0] == 'sleep':
+						# Each side counts separately
+						groups = tuple(self.children(element, dir) for dir in desc[1])
+					else:
+						groups = (self.children(element, desc[-1]),)
+					self.internals[element] = (desc, groups)
+	def __repr__(self):
+		return '<Iterative %d nodes, depth %d>' % (len(self.nodes), self.depth)
+
+	def children(self, element, dirs):
+		"""Gives the nodes for the neighbors of element in dirs. A node
+		   is a port, a WireNet, or a (WireNet, port) pair for a port
+		   that does not read back its own drive."""
+		nodes = []
+		for dir in dirs:
+			neighbor = element.getNeighbor(dir)
+			if neighbor is not None:
+				port = (neighbor, oppositeDir[dir])
+				if port not in self.ports:
+					self.ports[port] = neighbor.compilePoll(port[1])
+				if self.ports[port] is not None:
+					if hasattr(neighbor, 'nets') and port[1] in neighbor.nets:
+						net = neighbor.nets[port[1]]
+						nodes.append(net if net.sources(*port) is net.inputs else (net, port))
+					else:
+						nodes.append(port)
+		return tuple(nodes)
+
+	def describe(self, node):
+		"""Gives (op, argument, groups) for a node, where each group is a
+		   tuple of nodes to be or'd together as one operand."""
+		if node not in self.nodes:
+			if isinstance(node, WireNet) or isinstance(node[0], WireNet):
+				sources = node.inputs if isinstance(node, WireNet) else node[0].sources(*node[1])
+				op, arg, groups = 'wire', None, (sum((self.children(element, dir) for element, dir in sources), ()),)
+			else:
+				element, side = node
+				desc = self.ports.get(node) or element.compilePoll(side)
+				op = desc[0]
+				if op in ('wire', 'not'):
+					arg, groups = None, (self.children(element, desc[1]),)
+				elif op in ('and', 'or', 'xor'):
+					arg, groups = None, (self.children(element, desc[1]), self.children(element, desc[2]))
+				elif op == 'switch':
+					arg, groups = desc[1], (self.children(element, desc[2]), self.children(element, desc[3]))
+				elif op == 'memory':
+					arg, groups = element, (self.children(element, desc[1]), self.children(element, desc[2]))
+				elif op == 'cache':
+					arg, groups = (element, desc[1]), tuple(self.children(element, dir) for dir in desc[1])
+				elif op in ('delay', 'random'):
+					arg, groups = element, ()
+				elif op in ('input', 'storage'):
+					arg, groups = desc[1], ()
+				elif op in ('pulse', 'source'):
+					arg, groups = None, ()
+				else:
+					raise ValueError("'%s' is not a valid port description" % (op))
+			self.nodes[node] = (op, arg, groups)
+		return self.nodes[node]
+
+	def value(self, node):
+		"""Evaluates a node, and any node it reads that has not been
+		   evaluated yet this cycle. Each node being evaluated has a frame
+		   on the stack, a generator that yields the nodes it reads, one
+		   at a time, and is sent their values."""
+		values = self.values
+		if node in values:
+			return values[node]
+		if not self.describe(node)[2]:
+			values[node] = self.source(node)
+			return values[node]
+		active = {node}
+		stack = [(node, self.frame(node))]
+		depth = 1
+		value = None
+		while stack:
+			node, frame = stack[-1]
+			try:
+				child = frame.send(value)
+			except StopIteration as result:
+				stack.pop()
+				active.discard(node)
+				value = values[node] = result.value
+				continue
+			if child in values:
+				value = values[child]
+			elif child in active:
+				value = self.reentry(child)
+			elif not self.describe(child)[2]:
+				# Sources read nothing, so need no frame
+				value = values[child] = self.source(child)
+			else:
+				active.add(child)
+				stack.append((child, self.frame(child)))
+				value = None
+				if len(stack) > depth:
+					depth = len(stack)
+		if depth > self.depth:
+			self.depth = depth
+			if self.board.instrument:
+				self.board.stats['poll.depth'] = depth
+		return value
+
+	def frame(self, node):
+		"""Gives the value of a node, reading the nodes it needs by
+		   yielding them. Operands are short-circuited as in poll."""
+		op, arg, groups = self.describe(node)
+		if op == 'wire':
+			for child in groups[0]:
+				if (yield child):
+					return 1
+			return 0
+		elif op == 'and':
+			a = yield from self.operand(groups[0])
+			return (yield from self.operand(groups[1])) if a else 0
+		elif op == 'or':
+			a = yield from self.operand(groups[0])
+			return 1 if a else (yield from self.operand(groups[1]))
+		elif op == 'xor':
+			a = yield from self.operand(groups[0])
+			return a ^ (yield from self.operand(groups[1]))
+		elif op == 'not':
+			return 1 - (yield from self.operand(groups[0]))
+		elif op == 'switch':
+			a = yield from self.operand(groups[0])
+			return (yield from self.operand(groups[1])) if a == arg else 0
+		elif op == 'memory':
+			# Write-through, as Memory.poll runs its pollInternal first
+			if (yield from self.operand(groups[0])):
+				arg.currValue = yield from self.operand(groups[1])
+			return arg.currValue
+		elif op == 'cache':
+			element, dirs = arg
+			value = 0
+			for dir, group in zip(dirs, groups):
+				if element.inAges[dir] != self.board.age:
+					element.inAges[dir] = self.board.age
+					element.inValues[dir] = yield from self.operand(group)
+				value = value or element.inValues[dir]
+			return value
+
+	def reentry(self, node):
+		"""Gives the value of a node polled again while it is still
+		   being evaluated: what a Cache holds, or low for any other."""
+		op, arg, groups = self.describe(node)
+		if op == 'cache':
+			element, dirs = arg
+			return 1 if any(element.inValues[dir] for dir in dirs) else 0
+		return 0
+
+	def source(self, node):
+		"""Gives the value of a node that reads no other nodes."""
+		board = self.board
+		op, arg, groups = self.nodes[node]
+		if op == 'delay':
+			return arg.currValue if arg.age == board.age else arg.nextValue
+		elif op == 'input':
+			return board.readBit(arg)
+		elif op == 'storage':
+			return board.readStorageBit(arg)
+		elif op == 'random':
+			# One value per element each cycle, for every side it is read from
+			if arg.age != board.age:
+				arg.value = random.getrandbits(1)
+				arg.age = board.age
+			return arg.value
+		elif op == 'pulse':
+			return 1 if board.age == 1 else 0
+		elif op == 'source':
+			return 1
+
+	def operand(self, group):
+		for child in group:
+			if (yield child):
+				return 1
+		return 0
+
+	def poll(self, group):
+		"""Gives the or of a group of nodes, the same value pollNeighbor
+		   would give for the neighbors they were found from."""
+		for node in group:
+			if self.value(node):
+				return 1
+		return 0
+
+	def pollInternal(self, element):
+		"""Does the work of element.pollInternal, polling through the stack."""
+		board = self.board
+		desc, groups = self.internals[element]
+		op = desc[0]
+		if op == 'storagecontrol':
+			board.setStorageControl(element, desc[1], self.poll(groups[0]))
+		elif op == 'storagewrite':
+			if board.usesWriteHead(desc[1] // 8):
+				board.writeStorageBit(desc[1], self.poll(groups[0]))
+		elif op == 'memory':
+			self.value((element, element.flavor[0]))
+		elif op == 'sleep':
+			board.addSleep(Sleep.sleep_ramp[sum(self.poll(group) for group in groups)])
+		elif op == 'pause':
+			if self.poll(groups[0]):
+				board.addSleep((board.storageheadr & 0xff) * desc[1])
+		elif op == 'delay':
+			if element.age != board.age:
+				element.currValue = element.nextValue
+				element.age = board.age
+				element.nextValue = self.poll(groups[0])
+		elif op == 'bookmark':
+			value = self.poll(groups[0])
+			if element.state != value:
+				element.state = value
+				if value:
+					# mark
+					element.mark = board.age
+				else:
+					# recall
+					distance = board.age+1 - element.mark
+					element.mark = None
+					board.setJump(-distance)
+		elif op == 'control':
+			statuscode = {'T':Board.WRITE_HOLD | Board.TERMINATE, 't':Board.TERMINATE,
+			              'S':Board.WRITE_HOLD, 's':Board.READ_HOLD}[desc[1]]
+			if board.checkStatus(statuscode) != statuscode and self.poll(groups[0]):
+				board.addStatus(statuscode)
+		elif op == 'output':
+			if not board.checkStatus(Board.WRITE_HOLD):
+				board.writeBit(desc[1], self.poll(groups[0]))
+		elif op == 'debug':
+			element.addDebug(self.poll(groups[0]))
+		if board.instrument:
+			element.calls += 1
+
+	def run(self, inbits):
+		board = self.board
+		board.beginCycle(inbits)
+		self.values = {}
+
+		for cls in PRIORITYLIST:
+			for element in board.terminals[cls]:
+				if isinstance(element, Element):
+					self.pollInternal(element)
+				else:
+					element()
+
+		if board.instrument:
+			board.stats['poll.frame'] += len(self.values)
+		return board.endCycle()
+
+	def marks(self):
+		return self.board.marks()
+
+class Memo(object):
+	"""Runs a Board with the poll engine, but keeps the result of each
+	   poll of an (element, side) for the rest of the cycle, as if every
+	   fan-out point had a cache element (K). A port polled again while
+	   it is still being polled reads low, instead of recursing. The
+	   Cache elements themselves are left to keep their values as they
+	   do, so that one polled again reads what it cached. After
+	   an element's pollInternal, the results of its volatile sides are
+	   forgotten, so that they are polled again if needed. A port polled
+	   deeper than the recursion limit allows is handed to an Iterative,
+	   which keeps its own stack, rather than read low. The hits and
+	   misses are kept in the memo.hit and memo.miss stats, if the board
+	   is instrumented."""
+
+	def __init__(self, board):
+		self.board = board
+		self.values = {}
+		self.depth = 0
+		# Each memoized poll takes a few Python frames, through pollNeighbor
+		# and any net, so this stays well within the recursion limit
+		self.limit = sys.getrecursionlimit() // 8
+		self.iterative = None
+		for layer in board.cboard:
+			for row in layer:
+				for element in row:
+					if not isinstance(element, Cache):
+						element.poll = self.memoize(element, element.poll)
+	def __repr__(self):
+		return '<Memo %d ports>' % (len(self.values),)
+
+	def memoize(self, element, poll):
+		"""Wraps the poll of an element, which may be its pollNet."""
+		stats = self.board.stats
+		def memoPoll(side):
+			port = (element, side)
+			values = self.values
+			if port in values:
+				return values[port]
+			if self.depth >= self.limit:
+				value = values[port] = self.deepPoll(element, side, poll)
+				return value
+			values[port] = 0
+			self.depth += 1
+			try:
+				value = values[port] = poll(side)
+			except:
+				# An unfinished poll must not leave the low it read while
+				# being polled
+				del values[port]
+				raise
+			finally:
+				self.depth -= 1
+			return value
+		def memoPollCounted(side):
+			port = (element, side)
+			values = self.values
+			if port in values:
+				stats['memo.hit'] += 1
+				return values[port]
+			stats['memo.miss'] += 1
+			if self.depth >= self.limit:
+				value = values[port] = self.deepPoll(element, side, poll)
+				return value
+			values[port] = 0
+			self.depth += 1
+			try:
+				value = values[port] = poll(side)
+			except:
+				del values[port]
+				raise
+			finally:
+				self.depth -= 1
+			return value
+		return memoPollCounted if self.board.instrument else memoPoll
+
+	def deepPoll(self, element, side, poll):
+		"""Gives the value of a port too deep to poll, from the Iterative,
+		   which reads the same element state."""
+		neighbor = element.getNeighbor(side)
+		if neighbor is None:
+			return poll(side) or 0
+		if self.iterative is None:
+			self.iterative = Iterative(self.board)
+		return self.iterative.poll(self.iterative.children(neighbor, oppositeDir[side]))
+
+	def run(self, inbits):
+		board = self.board
+		board.beginCycle(inbits)
+		self.values = {}
+		if self.iterative is not None:
+			self.iterative.values = {}
+
+		for cls in PRIORITYLIST:
+			for element in board.terminals[cls]:
+				element()
+				for side in getattr(element, 'volatile', ''):
+					self.values.pop((element, side), None)
+					if self.iterative is not None:
+						self.iterative.values.pop((element, side), None)
+
+		return board.endCycle()
+
+	def marks(self):
+		return self.board.marks()
+
+class Profiler(object):
+	"""Runs a Board with the poll engine, timing every poll and internal
+	   poll. Each element keeps its polls, internal polls, and the time
+	   spent in them, both inclusive of the polls they make, and its own
+	   share without them. Time is also kept for each terminal class in
+	   PRIORITYLIST, for each cycle, and for each stack of polls, which
+	   begins with the terminal class and the element being run. A
+	   recursive poll counts again in the inclusive time of each of its
+	   frames, but only once in the self times."""
+
+	def __init__(self, board):
+		self.board = board
+		self.stack = []
+		self.childtime = [0.0]
+		self.elements = {}
+		self.classes = {cls:[0, 0.0] for cls in PRIORITYLIST}
+		self.stacks = defaultdict(float)
+		self.latencies = []
+		for layer in board.cboard:
+			for row in layer:
+				for element in row:
+					self.elements[element] = [0, 0, 0.0, 0.0]
+					element.poll = self.profile(element, element.poll)
+	def __repr__(self):
+		return '<Profiler %d cycles>' % (len(self.latencies),)
+
+	@staticmethod
+	def frame(element):
+		return '%s(%d,%d,%d)' % (element.__class__.__name__, element.z, element.y, element.x)
+
+	def timed(self, name, function, *args):
+		"""Calls function under a new frame of the stack, and gives its
+		   result, with the time it took, inclusive and exclusive of the
+		   frames under it."""
+		stack = self.stack
+		childtime = self.childtime
+		stack.append(name)
+		childtime.append(0.0)
+		start = time.perf_counter()
+		try:
+			value = function(*args)
+		finally:
+			elapsed = time.perf_counter() - start
+			own = elapsed - childtime.pop()
+			self.stacks[tuple(stack)] += own
+			stack.pop()
+			childtime[-1] += elapsed
+		return value, elapsed, own
+
+	def profile(self, element, poll):
+		"""Wraps the poll of an element, which may be its pollNet."""
+		name = self.frame(element)
+		counts = self.elements[element]
+		def profiledPoll(side):
+			value, elapsed, own = self.timed(name, poll, side)
+			counts[0] += 1
+			counts[2] += elapsed
+			counts[3] += own
+			return value
+		return profiledPoll
+
+	def run(self, inbits):
+		board = self.board
+		start = time.perf_counter()
+		board.beginCycle(inbits)
+
+		for cls in PRIORITYLIST:
+			totals = self.classes[cls]
+			self.stack.append(cls.__name__)
+			self.childtime.append(0.0)
+			for element in board.terminals[cls]:
+				if isinstance(element, Element):
+					value, elapsed, own = self.timed(self.frame(element), element)
+					counts = self.elements[element]
+					counts[1] += 1
+					counts[2] += elapsed
+					counts[3] += own
+				else:
+					self.timed(element.__name__, element)
+				totals[0] += 1
+			self.stack.pop()
+			totals[1] += self.childtime.pop()
+
+		result = board.endCycle()
+		self.latencies.append(time.perf_counter() - start)
+		return result
+
+	def marks(self):
+		return self.board.marks()
+
+	def report(self):
+		"""Gives the results as a dict of plain values, suitable for
+		   json. Times are in seconds, and elements are ordered by their
+		   self time, most first."""
+		latencies = sorted(self.latencies)
+		def percentile(p):
+			return latencies[min(len(latencies)-1, int(p*len(latencies)))] if latencies else 0.0
+		elements = [{'x':element.x, 'y':element.y, 'z':element.z, 'lexeme':element.lexeme,
+		             'type':element.__class__.__name__, 'polls':counts[0], 'internal':counts[1],
+		             'inclusive':counts[2], 'self':counts[3]}
+		            for element, counts in self.elements.items() if counts[0] or counts[1]]
+		elements.sort(key=lambda entry: (-entry['self'], entry['z'], entry['y'], entry['x']))
+		return {'cycles':len(latencies),
+		        'latency':{'total':sum(latencies), 'mean':sum(latencies)/len(latencies) if latencies else 0.0,
+		                   'min':latencies[0] if latencies else 0.0, 'p50':percentile(0.5), 'p90':percentile(0.9),
+		                   'p99':percentile(0.99), 'max':latencies[-1] if latencies else 0.0},
+		        'classes':{cls.__name__:{'calls':totals[0], 'time':totals[1]} for cls, totals in self.classes.items()},
+		        'elements':elements}
+	def folded(self):
+		"""Gives the stacks of polls in the collapsed format used by
+		   flamegraph tools: each line is the frames, outermost first,
+		   separated by semicolons, then the self time of the stack, in
+		   whole microseconds."""
+		lines = []
+		for stack, own in sorted(self.stacks.items()):
+			if int(own*1e6) > 0:
+				lines.append('%s %d\n' % (';'.join(stack), own*1e6))
+		return ''.join(lines)
+
+class Netlist(object):
+	"""A flat form of an initialized Board, made only of gates and state
+	   cells. Wires, pins, diodes and the other passive elements are
+	   collapsed into direct connections, and the nodes are ordered so
+	   that one cycle is a single linear pass over them. The Board still
+	   holds the storage, age, and status."""
+
+	def __init__(self, board):
+		self.board = board
+		self.values = [0, 1] # Nodes 0 and 1 are the constants low and high
+		self.keys = {}
+		self.nets = {}
+		self.ports = {}
+		self.drivers = {}
+		self.gates = []
+		self.cyclic = []
+		self.pending = []
+		self.inputs = []
+		self.storagebits = []
+		self.randoms = []
+		self.pulses = []
+		self.delays = []
+		self.delayslots = {}
+		self.storagecontrols = []
+		self.storagewrites = []
+		self.sleeps = []
+		self.pauses = []
+		self.bookmarks = []
+		self.controls = []
+		self.outputs = []
+		self.debugs = []
+		self.compile()
+	def __repr__(self):
+		return '<Netlist %d nodes, %d gates>' % (len(self.values), len(self.gates))
+
+	def compile(self):
+		for cls in PRIORITYLIST:
+			elements = [element for element in self.board.terminals[cls] if isinstance(element, Element)]
+			for element in sorted(elements, key=lambda element: (element.z, element.y, element.x)):
+				self.addTerminal(element, element.compileInternal())
+		while self.pending:
+			self.addGate(*self.pending.pop())
+		self.order()
+		self.simplify()
+		self.check()
+
+	def addTerminal(self, element, desc):
+		op = desc[0]
+		if op == 'storagecontrol':
+			self.storagecontrols.append((len(self.storagecontrols), desc[1], self.resolve(element, desc[2])))
+		elif op == 'storagewrite':
+			self.storagewrites.append((desc[1], self.resolve(element, desc[2])))
+		elif op == 'memory':
+			self.activate(element, None, desc)
+		elif op == 'sleep':
+			self.sleeps.append(tuple(self.resolve(element, dir) for dir in desc[1]))
+		elif op == 'pause':
+			self.pauses.append((desc[1], self.resolve(element, desc[2])))
+		elif op == 'delay':
+			delay = self.delayslots[self.activate(element, None, desc)]
+			delay[1] = self.resolve(element, desc[1])
+		elif op == 'bookmark':
+			self.bookmarks.append([self.resolve(element, desc[1]), 0, None])
+		elif op == 'control':
+			statuscode = {'T':Board.WRITE_HOLD | Board.TERMINATE, 't':Board.TERMINATE,
+			              'S':Board.WRITE_HOLD, 's':Board.READ_HOLD}[desc[1]]
+			self.controls.append((statuscode, self.resolve(element, desc[2])))
+		elif op == 'output':
+			self.outputs.append((desc[1], self.resolve(element, desc[2])))
+		elif op == 'debug':
+			self.debugs.append((element.lexeme, element.z, element.y, element.x, self.resolve(element, desc[1])))
+		else:
+			raise ValueError("'%s' is not a valid terminal description" % (op))
+
+	def describe(self, port):
+		if port not in self.ports:
+			self.ports[port] = port[0].compilePoll(port[1])
+		return self.ports[port]
+
+	def follow(self, element, dirs):
+		"""Looks at the neighbors of element in dirs, and splits them into
+		   the passive ports to keep following, and the nodes that
+		   drive a value directly."""
+		passive = []
+		active = set()
+		for dir in dirs:
+			neighbor = element.getNeighbor(dir)
+			if neighbor is not None:
+				port = (neighbor, oppositeDir[dir])
+				desc = self.describe(port)
+				if desc is None:
+					pass
+				elif desc[0] == 'wire':
+					passive.append(port)
+				else:
+					active.add(self.activate(neighbor, port[1], desc))
+		return passive, active
+
+	def reach(self, port):
+		"""Finds the set of nodes that drive a passive port. Loops of
+		   passive elements are solved as a whole, so every port in a
+		   loop is driven by the same nodes."""
+		if port not in self.drivers:
+			links = {}
+			def successors(port):
+				if port not in links:
+					links[port] = self.follow(port[0], self.describe(port)[1])
+				return [child for child in links[port][0] if child not in self.drivers]
+			for component in stronglyConnected([port], successors):
+				drivers = set()
+				for member in component:
+					passive, active = links[member]
+					drivers |= active
+					for child in passive:
+						drivers |= self.drivers.get(child, frozenset())
+				drivers = frozenset(drivers)
+				for member in component:
+					self.drivers[member] = drivers
+		return self.drivers[port]
+
+	def resolve(self, element, dirs):
+		"""Gives the node holding the or of the neighbors of element in
+		   dirs, the same value pollNeighbor would give."""
+		passive, drivers = self.follow(element, dirs)
+		for port in passive:
+			drivers |= self.reach(port)
+		if not drivers:
+			return 0
+		elif 1 in drivers:
+			return 1
+		elif len(drivers) == 1:
+			return next(iter(drivers))
+		key = frozenset(drivers)
+		if key not in self.nets:
+			self.nets[key] = len(self.values)
+			self.values.append(0)
+			self.gates.append(('any', self.nets[key], tuple(sorted(key)), None))
+		return self.nets[key]
+
+	def activate(self, element, side, desc):
+		"""Gives the node for an active port, creating it if needed."""
+		op = desc[0]
+		if op == 'source':
+			return 1
+		elif op in ('input', 'storage'):
+			key = desc
+		elif op == 'pulse':
+			key = (op,)
+		elif op in ('random', 'delay', 'memory'):
+			key = (op, element)
+		else:
+			key = (element, side)
+		if key not in self.keys:
+			index = self.keys[key] = len(self.values)
+			self.values.append(0)
+			if op == 'input':
+				self.inputs.append((index, desc[1]))
+			elif op == 'storage':
+				self.storagebits.append((index, desc[1]))
+			elif op == 'pulse':
+				self.pulses.append(index)
+			elif op == 'random':
+				self.randoms.append(index)
+			elif op == 'delay':
+				self.delayslots[index] = [index, 0, 0]
+				self.delays.append(self.delayslots[index])
+			else:
+				self.pending.append((index, element, desc))
+		return self.keys[key]
+
+	def addGate(self, index, element, desc):
+		op = desc[0]
+		if op in ('and', 'or', 'xor', 'memory'):
+			self.gates.append((op, index, self.resolve(element, desc[1]), self.resolve(element, desc[2])))
+		elif op == 'not':
+			self.gates.append(('xor', index, self.resolve(element, desc[1]), 1))
+		elif op == 'switch':
+			control = self.resolve(element, desc[2])
+			data = self.resolve(element, desc[3])
+			if desc[1]:
+				self.gates.append(('and', index, data, control))
+			else:
+				self.gates.append(('andnot', index, data, control))
+		elif op == 'cache':
+			self.gates.append(('any', index, tuple(self.cacheCell(element, dir) for dir in desc[1]), None))
+		else:
+			raise ValueError("'%s' is not a valid gate description" % (op))
+
+	def cacheCell(self, element, dir):
+		"""Gives the node for the neighbor a Cache reads in dir. It keeps
+		   its value from one cycle to the next, so that in a loop, the
+		   gates ordered before it read the value it had last cycle, as
+		   a poll that comes back to the Cache reads what it cached."""
+		key = ('cache', element, dir)
+		if key not in self.keys:
+			index = self.keys[key] = len(self.values)
+			self.values.append(0)
+			self.gates.append(('cache', index, self.resolve(element, dir), None))
+		return self.keys[key]
+
+	@staticmethod
+	def reads(gate):
+		"""Gives the nodes that a gate reads"""
+		op, index, a, b = gate
+		if op == 'any':
+			return a
+		elif op == 'cache':
+			return (a,)
+		return (a, b)
+
+	def held(self):
+		"""Gives the gates that keep their value from one cycle to the
+		   next, the Memory and Cache cells"""
+		return list(dict.fromkeys(gate[1] for gate in self.gates if gate[0] in ('memory', 'cache')))
+
+	def order(self):
+		"""Sorts the gates so that each comes after the nodes it reads.
+		   Gates in a loop read low from the members not yet evaluated
+		   this cycle, rather than recursing on them. A loop through a
+		   Cache is run twice: first with its Cache cells as they were
+		   last cycle, as a poll that comes back to a Cache reads what
+		   it cached, and then, once the cells are set, every other gate
+		   again, as it would be polled after the Cache. A Cache cell
+		   outside of a loop is a plain wire."""
+		gates = {gate[1]:gate for gate in self.gates}
+		def successors(index):
+			return [dep for dep in Netlist.reads(gates[index]) if dep in gates]
+		self.gates = []
+		self.cyclic = []
+		for component in stronglyConnected(sorted(gates), successors):
+			if len(component) > 1 or component[0] in successors(component[0]):
+				self.cyclic += [index for index in component if gates[index][0] not in ('memory', 'cache')]
+				caches = [index for index in component if gates[index][0] == 'cache']
+				if caches:
+					rest = set(component).difference(caches)
+					inner = [index for part in stronglyConnected(sorted(rest), lambda index: [dep for dep in successors(index) if dep in rest])
+					         for index in part]
+					component = inner + caches + inner
+			elif gates[component[0]][0] == 'cache':
+				op, index, a, b = gates[component[0]]
+				gates[index] = ('any', index, (a,), None)
+			self.gates += [gates[index] for index in component]
+
+	def simplify(self):
+		"""Folds away gates with constant or repeated inputs, and then
+		   gates that nothing reads. Gates in a loop are left alone."""
+		alias = {}
+		cyclic = set(self.cyclic)
+		gates = []
+		for op, index, a, b in self.gates:
+			if op == 'any':
+				a = set(alias.get(dep, dep) for dep in a)
+				a.discard(0)
+			else:
+				a = alias.get(a, a)
+				b = alias.get(b, b)
+			if index in cyclic:
+				gates.append((op, index, tuple(sorted(a)) if op == 'any' else a, b))
+				continue
+			fold = None
+			if op == 'any':
+				if 1 in a:
+					fold = 1
+				elif len(a) <= 1:
+					fold = a.pop() if a else 0
+				else:
+					a = tuple(sorted(a))
+			elif op == 'and':
+				if a == 0 or b == 0:
+					fold = 0
+				elif a == 1 or a == b:
+					fold = b
+				elif b == 1:
+					fold = a
+			elif op == 'or':
+				if a == 1 or b == 1:
+					fold = 1
+				elif a == 0 or a == b:
+					fold = b
+				elif b == 0:
+					fold = a
+			elif op == 'xor':
+				if a == b:
+					fold = 0
+				elif a == 0:
+					fold = b
+				elif b == 0:
+					fold = a
+			elif op == 'andnot':
+				if a == 0 or b == 1 or a == b:
+					fold = 0
+				elif b == 0:
+					fold = a
+				elif a == 1:
+					op, a, b = 'xor', b, 1
+			elif op == 'memory':
+				if a == 0:
+					# Never written, so it keeps its initial low
+					fold = 0
+				elif a == 1:
+					fold = b
+			if fold is None:
+				gates.append((op, index, a, b))
+			else:
+				alias[index] = fold
+
+		def rename(net):
+			while net in alias:
+				net = alias[net]
+			return net
+		# A gate in a loop may read one folded after it was reached
+		for position, (op, index, a, b) in enumerate(gates):
+			if op == 'any':
+				a = set(map(rename, a))
+				a.discard(0)
+				gates[position] = (op, index, tuple(sorted(a)), b)
+			else:
+				gates[position] = (op, index, rename(a), rename(b))
+		self.storagecontrols = [(control, flavor, rename(net)) for control, flavor, net in self.storagecontrols]
+		self.storagewrites = [(bit, rename(net)) for bit, net in self.storagewrites]
+		self.sleeps = [tuple(rename(net) for net in nets) for nets in self.sleeps]
+		self.pauses = [(scale, rename(net)) for scale, net in self.pauses]
+		for delay in self.delays:
+			delay[1] = rename(delay[1])
+		for bookmark in self.bookmarks:
+			bookmark[0] = rename(bookmark[0])
+		self.controls = [(statuscode, rename(net)) for statuscode, net in self.controls]
+		self.outputs = [(bit, rename(net)) for bit, net in self.outputs]
+		self.debugs = [debug[:4] + (rename(debug[4]),) for debug in self.debugs]
+
+		# Keep only the gates that some terminal reads, directly or not
+		live = set(self.terminalNets())
+		# A gate in a loop may read one ordered after it, so the inputs
+		# are followed until no more are found, not in a single pass
+		inputs = {gate[1]:Netlist.reads(gate) for gate in gates}
+		pending = [net for net in live if net in inputs]
+		while pending:
+			for dep in inputs[pending.pop()]:
+				if dep not in live:
+					live.add(dep)
+					if dep in inputs:
+						pending.append(dep)
+		self.gates = [gate for gate in gates if gate[1] in live]
+		self.cyclic = [index for index in self.cyclic if index in live]
+
+	def check(self):
+		"""Raises ValueError unless the gates and terminals read only
+		   nodes that are set each cycle: the constants, the sources, and
+		   the gates kept"""
+		computed = {0, 1}
+		computed.update(index for index, bit in self.inputs)
+		computed.update(index for index, bit in self.storagebits)
+		computed.update(self.randoms)
+		computed.update(self.pulses)
+		computed.update(delay[0] for delay in self.delays)
+		computed.update(gate[1] for gate in self.gates)
+		read = [(gate[1], dep) for gate in self.gates for dep in Netlist.reads(gate)]
+		read += [('terminal', net) for net in self.terminalNets()]
+		for index, dep in read:
+			if dep not in computed:
+				raise ValueError('Node %d, read by %s, is never computed' % (dep, index))
+
+	def terminalNets(self):
+		"""Gives the nets read by the terminals"""
+		nets = [net for control, flavor, net in self.storagecontrols]
+		nets += [net for bit, net in self.storagewrites]
+		for group in self.sleeps:
+			nets += group
+		nets += [net for scale, net in self.pauses]
+		nets += [delay[1] for delay in self.delays]
+		nets += [bookmark[0] for bookmark in self.bookmarks]
+		nets += [net for statuscode, net in self.controls]
+		nets += [net for bit, net in self.outputs]
+		nets += [debug[4] for debug in self.debugs]
+		return nets
+
+	def evaluate(self, values):
+		"""Runs the gates over values, once the sources are set. Only
+		   bitwise operations are used, so each value may hold several
+		   independent lanes, as long as values[1] is high in all of them."""
+		for index in self.cyclic:
+			values[index] = 0
+		for op, index, a, b in self.gates:
+			if op == 'any':
+				value = 0
+				for dep in a:
+					value |= values[dep]
+				values[index] = value
+			elif op == 'and':
+				values[index] = values[a] & values[b]
+			elif op == 'or':
+				values[index] = values[a] | values[b]
+			elif op == 'xor':
+				values[index] = values[a] ^ values[b]
+			elif op == 'andnot':
+				values[index] = values[a] & ~values[b]
+			elif op == 'memory':
+				# Write-through: the new value is visible in this same cycle
+				value = values[index]
+				values[index] = value ^ ((value ^ values[b]) & values[a])
+			elif op == 'cache':
+				values[index] = values[a]
+
+	def run(self, inbits):
+		board = self.board
+		values = self.values
+		board.beginCycle(inbits)
+		for prepare in board.terminals[DummyPrepare]:
+			prepare()
+
+		for index, bit in self.inputs:
+			values[index] = inbits >> bit & 1
+		headr = board.storageheadr
+		for index, bit in self.storagebits:
+			values[index] = headr >> bit & 1
+		for index in self.randoms:
+			values[index] = random.getrandbits(1)
+		for index in self.pulses:
+			# Zero is the setup age, so pulse at age one.
+			values[index] = 1 if board.age == 1 else 0
+		for index, net, state in self.delays:
+			values[index] = state
+		self.evaluate(values)
+
+		for control, flavor, net in self.storagecontrols:
+			board.setStorageControl(control, flavor, values[net])
+		for bit, net in self.storagewrites:
+			if board.usesWriteHead(bit // 8):
+				board.writeStorageBit(bit, values[net])
+		for nets in self.sleeps:
+			board.addSleep(Sleep.sleep_ramp[sum(values[net] for net in nets)])
+		for scale, net in self.pauses:
+			if values[net]:
+				board.addSleep((board.storageheadr & 0xff) * scale)
+		for delay in self.delays:
+			delay[2] = values[delay[1]]
+		for bookmark in self.bookmarks:
+			value = values[bookmark[0]]
+			if bookmark[1] != value:
+				bookmark[1] = value
+				if value:
+					# mark
+					bookmark[2] = board.age
+				else:
+					# recall
+					distance = board.age+1 - bookmark[2]
+					bookmark[2] = None
+					board.setJump(-distance)
+		for statuscode, net in self.controls:
+			if values[net]:
+				board.addStatus(statuscode)
+		if not board.checkStatus(Board.WRITE_HOLD):
+			for bit, net in self.outputs:
+				board.writeBit(bit, values[net])
+		for lexeme, z, y, x, net in self.debugs:
+			board.addDebug(lexeme, z, y, x, values[net])
+
+		for finalize in board.terminals[DummyFinalize]:
+			finalize()
+		return board.endCycle()
+
+	def marks(self):
+		return [bookmark[2] for bookmark in self.bookmarks if bookmark[2] is not None]
+
+class Batch(object):
+	"""Runs a Netlist over many independent streams at once. Values are
+	   bit-sliced into Python ints with a stride of eight bits: lane k of
+	   a node is bit 8*k of its value. Each gate then evaluates every
+	   lane in one bitwise operation, and a byte from each lane packs
+	   into a single int with int.from_bytes. Every lane has its own
+	   input position, holds, termination, bookmarks and storage, and a
+	   lane is given the next stream as soon as its own stream ends.
+	   Storage is limited by limit and overflow as on a Board, and a
+	   write that halts ends only the stream of its own lane. Sleep and
+	   Pause elements are ignored."""
+
+	def __init__(self, netlist, lanes=64, storagemode='s', limit=None, overflow='drop', cutoff=-1, generator=None):
+		self.netlist = netlist
+		self.lanes = lanes
+		self.storagemode = storagemode
+		self.limit = limit
+		self.overflow = overflow
+		self.cutoff = cutoff
+		self.generator = generator
+	def __repr__(self):
+		return '<Batch %d lanes>' % (self.lanes)
+
+	def process(self, streams):
+		"""Runs each of streams (a sequence of bytes) through the circuit,
+		   and gives the output of each, in the same order. If generator
+		   is given, it is called for a new iterable of single bytes to
+		   use when a stream is exhausted, as with --generate."""
+		netlist = self.netlist
+		lanes = self.lanes
+		modes = self.storagemode
+		ones = int.from_bytes(b'\x01'*lanes, 'little')
+		streams = list(streams)
+		outputs = [bytearray() for stream in streams]
+
+		values = list(netlist.values)
+		values[1] = ones
+		delays = [[index, net, 0] for index, net, state in netlist.delays]
+		memories = netlist.held()
+		bookmarks = [[net, 0, [None]*lanes] for net, state, mark in netlist.bookmarks]
+		controls = [([net for control, flavor, net in netlist.storagecontrols if flavor == read],
+		             [net for control, flavor, net in netlist.storagecontrols if flavor == write])
+		            for read, write in Board.STORAGE_CONTROLS[:len(modes)]]
+		terminates = [net for statuscode, net in netlist.controls if statuscode & Board.TERMINATE]
+		writeholds = [net for statuscode, net in netlist.controls if statuscode & Board.WRITE_HOLD]
+		readholds = [net for statuscode, net in netlist.controls if statuscode & Board.READ_HOLD]
+
+		owner = [None]*lanes
+		data = [b'']*lanes
+		index = [0]*lanes
+		count = [0]*lanes
+		current = bytearray(lanes)
+		storage = [None]*lanes
+		generators = [None]*lanes
+		hold = 0
+		nextstream = 0
+		age = 0
+		while True:
+			# Read a byte for each lane that is not held, starting the next
+			# stream on any lane that is free
+			fresh = 0
+			for k in range(lanes):
+				if hold >> 8*k & 1:
+					continue
+				while owner[k] is not None or nextstream < len(streams):
+					if owner[k] is None:
+						owner[k] = nextstream
+						nextstream += 1
+						data[k] = streams[owner[k]]
+						index[k] = 0
+						count[k] = 0
+						storage[k] = [makeStorage(mode, self.limit, self.overflow) for mode in modes]
+						generators[k] = None
+						fresh |= 1 << 8*k
+					if count[k] >= self.cutoff > 0:
+						owner[k] = None
+						continue
+					if index[k] >= len(data[k]):
+						if self.generator is None:
+							owner[k] = None
+							continue
+						if generators[k] is None:
+							generators[k] = iter(self.generator())
+							data[k] = bytearray(data[k])
+						data[k] += next(generators[k])
+					current[k] = data[k][index[k]]
+					index[k] += 1
+					count[k] += 1
+					break
+			alive = sum(1 << 8*k for k in range(lanes) if owner[k] is not None)
+			if not alive:
+				break
+			if fresh:
+				# New streams start from the initial state
+				for delay in delays:
+					delay[2] &= ~fresh
+				for memory in memories:
+					values[memory] &= ~fresh
+				for bookmark in bookmarks:
+					bookmark[1] &= ~fresh
+			age += 1
+
+			# Sources
+			inputs = int.from_bytes(current, 'little')
+			for node, bit in netlist.inputs:
+				values[node] = inputs >> bit & ones
+			if netlist.storagebits:
+				# One head per storage unit, each with a byte for each lane
+				heads = [int.from_bytes(bytes((storage[k][unit].peek() if owner[k] is not None else 0) for k in range(lanes)),
+				                        'little') for unit in range(len(modes))] + [0]
+				for node, bit in netlist.storagebits:
+					values[node] = heads[min(bit // 8, len(modes))] >> bit % 8 & ones
+			for node in netlist.randoms:
+				values[node] = random.getrandbits(8*lanes) & ones
+			for node in netlist.pulses:
+				values[node] = fresh
+			for node, net, state in delays:
+				values[node] = state
+
+			netlist.evaluate(values)
+
+			# Terminals, for all lanes at once
+			for delay in delays:
+				delay[2] = values[delay[1]]
+			readhold = writehold = terminate = outbits = 0
+			for net in readholds:
+				readhold |= values[net]
+			for net in writeholds:
+				writehold |= values[net]
+			for net in terminates:
+				terminate |= values[net]
+			headws = [0]*(len(modes) + 1)
+			for bit, net in netlist.storagewrites:
+				headws[min(bit // 8, len(modes))] |= values[net] << bit % 8
+			for bit, net in netlist.outputs:
+				outbits |= values[net] << bit
+			outbits &= ~(writehold * 0xff)
+			jumps = {}
+			for bookmark in bookmarks:
+				changed = (values[bookmark[0]] ^ bookmark[1]) & alive
+				bookmark[1] = values[bookmark[0]]
+				for k in range(lanes):
+					if changed >> 8*k & 1:
+						if bookmark[1] >> 8*k & 1:
+							# mark
+							bookmark[2][k] = age
+						else:
+							# recall
+							jump = bookmark[2][k] - age - 1
+							bookmark[2][k] = None
+							jumps[k] = min(jumps.get(k, jump), jump)
+
+			# Then lane by lane
+			hold = readhold & ~terminate & alive
+			outbits = outbits.to_bytes(lanes, 'little')
+			writehold = writehold.to_bytes(lanes, 'little')
+			terminate = terminate.to_bytes(lanes, 'little')
+			# Only the storage units with a control set in some lane
+			active = []
+			for unit, (reads, writes) in enumerate(controls):
+				ctlr = ctlw = 0
+				for net in reads:
+					ctlr |= values[net]
+				for net in writes:
+					ctlw |= values[net]
+				if (ctlr | ctlw) & alive:
+					active.append((unit, ctlr.to_bytes(lanes, 'little'), ctlw.to_bytes(lanes, 'little'),
+					               headws[unit].to_bytes(lanes, 'little')))
+			for k in range(lanes):
+				if owner[k] is None:
+					continue
+				halted = False
+				for unit, ctlr, ctlw, headw in active:
+					if modes[unit] == 'm':
+						if ctlw[k]:
+							storage[k][unit].write(headw[k])
+						if ctlr[k]:
+							storage[k][unit].seek(headw[k])
+					else:
+						if ctlr[k] and storage[k][unit]:
+							storage[k][unit].pop()
+						if ctlw[k]:
+							if not storage[k][unit].push(headw[k]) and self.overflow == 'halt':
+								halted = True
+				if not writehold[k]:
+					outputs[owner[k]].append(outbits[k])
+				if terminate[k] or halted:
+					owner[k] = None
+					# A lane that halted while held is free for the next stream
+					hold &= ~(1 << 8*k)
+				elif k in jumps:
+					index[k] += jumps[k]
+
+		return [bytes(output) for output in outputs]
+
+class Machine(object):
+	"""Runs a Netlist whose only state is a few Delay, Memory and Cache
+	   cells as a finite state machine. Starting from the initial state, every
+	   reachable state is run against all 256 input bytes at once, in
+	   bit-sliced lanes as in Batch, and several states together,
+	   giving a table of the output byte, status code and next state for
+	   each (state, input byte) pair. Raises ValueError if the circuit
+	   uses storage, Random, Pulse, Sleep, Pause or Bookmark elements,
+	   reaches more than limit states, or has more cells than limit
+	   states could hold and is not done within a short probe."""
+
+	# The most states evaluated together, and the lanes of a state with
+	# a cell low or high
+	BLOCK = 16
+	LANE_BITS = (bytes(256), b'\x01'*256)
+	# The evaluations made to look for the states of a circuit with more
+	# cells than limit states could hold. Most such circuits have far
+	# too many states, so this is only a short probe.
+	PROBE = 32
+
+	def __init__(self, netlist, limit=1024):
+		self.netlist = netlist
+		if netlist.storagebits or netlist.randoms or netlist.pulses:
+			raise ValueError('The circuit reads storage, random or pulse values')
+		if any(net for control, flavor, net in netlist.storagecontrols) or\
+		   any(any(nets) for nets in netlist.sleeps) or\
+		   any(net for scale, net in netlist.pauses) or\
+		   any(bookmark[0] for bookmark in netlist.bookmarks):
+			raise ValueError('The circuit uses storage, sleep, pause or bookmark elements')
+		self.cells = [delay[0] for delay in netlist.delays] + netlist.held()
+		self.controlled = any(net for statuscode, net in netlist.controls)
+		self.outputs = bytearray()
+		self.status = bytearray()
+		self.nexts = []
+		self.states = 0
+		self.tabulate(limit)
+		self.state = 0
+		# The cycles run, as in Board.age
+		self.age = 0
+	def __repr__(self):
+		return '<Machine %d cells, %d states>' % (len(self.cells), self.states)
+
+	def tabulate(self, limit):
+		netlist = self.netlist
+		nextcells = [delay[1] for delay in netlist.delays] + self.cells[len(netlist.delays):]
+		inputs = [bytes(value >> bit & 1 for value in range(256)) for bit in range(8)]
+		values = list(netlist.values)
+
+		# A state is a tuple of its cells, eight to a byte. States are
+		# numbered as they are found, and each number is kept shifted left
+		# by eight, ready to be or'd with an input byte.
+		groups = [nextcells[start:start+8] for start in range(0, len(nextcells), 8)]
+		initial = (0,)*len(groups)
+		numbers = {initial:0}
+		found = [initial]
+		passes = limit if len(self.cells) <= limit.bit_length() else Machine.PROBE
+		start = 0
+		while start < len(found):
+			if passes == 0:
+				raise ValueError('The circuit has too many states to find in %d passes' % (Machine.PROBE))
+			passes -= 1
+			# Up to BLOCK states at once, each given 256 lanes for the 256
+			# input bytes, in the order of their numbers
+			block = found[start:start+Machine.BLOCK]
+			start += len(block)
+			lanes = 256 * len(block)
+			values[1] = int.from_bytes(b'\x01'*lanes, 'little')
+			for index, bit in netlist.inputs:
+				values[index] = int.from_bytes(inputs[bit] * len(block), 'little')
+			for bit, index in enumerate(self.cells):
+				values[index] = int.from_bytes(b''.join(Machine.LANE_BITS[cellbytes[bit >> 3] >> (bit & 7) & 1]
+				                                        for cellbytes in block), 'little')
+			netlist.evaluate(values)
+
+			outbits = statuscode = 0
+			for bit, net in netlist.outputs:
+				outbits |= values[net] << bit
+			for code, net in netlist.controls:
+				statuscode |= values[net] * code
+			self.outputs += outbits.to_bytes(lanes, 'little')
+			self.status += statuscode.to_bytes(lanes, 'little')
+
+			# The next cells of every lane at once, each group of eight
+			# packed into a byte per lane, and zipped into a state per lane
+			if groups:
+				nextbytes = list(zip(*[sum(values[net] << bit for bit, net in enumerate(group)).to_bytes(lanes, 'little')
+				                       for group in groups]))
+			else:
+				nextbytes = [initial]*lanes
+			for cellbytes in [cellbytes for cellbytes in dict.fromkeys(nextbytes) if cellbytes not in numbers]:
+				if len(found) >= limit:
+					raise ValueError('The circuit has more than %d states' % (limit))
+				numbers[cellbytes] = len(found) << 8
+				found.append(cellbytes)
+			self.nexts += map(numbers.__getitem__, nextbytes)
+		self.states = len(found)
+
+	def process(self, chunk):
+		"""Runs the machine over chunk, a bytes-like object. Gives the
+		   output, and whether the circuit terminated."""
+		outputs = self.outputs
+		nexts = self.nexts
+		state = self.state
+		output = bytearray()
+		if not self.controlled:
+			for byte in chunk:
+				entry = state | byte
+				output.append(outputs[entry])
+				state = nexts[entry]
+			self.state = state
+			self.age += len(chunk)
+			return bytes(output), False
+
+		status = self.status
+		index = 0
+		while index < len(chunk):
+			self.age += 1
+			entry = state | chunk[index]
+			statuscode = status[entry]
+			state = nexts[entry]
+			if not (statuscode & Board.WRITE_HOLD):
+				output.append(outputs[entry])
+			if statuscode & Board.TERMINATE:
+				self.state = state
+				return bytes(output), True
+			if not (statuscode & Board.READ_HOLD):
+				index += 1
+		self.state = state
+		return bytes(output), False
+
+class Codegen(object):
+	"""Runs a Netlist through Python source generated for that one
+	   circuit. Every poll is inlined as an expression on local
+	   variables, so all dispatch happens once, at load time. The
+	   generated function is pure; it takes the input bits, the storage
+	   read head, the age and the state of the Delay, Memory, Cache and
+	   Bookmark elements, and returns the next state and the output."""
+
+	def __init__(self, netlist):
+		self.netlist = netlist
+		self.board = netlist.board
+		self.source = self.generate()
+		namespace = {'getrandbits':random.getrandbits, 'SLEEP_RAMP':Sleep.sleep_ramp}
+		exec(compile(self.source, '<chip circuit>', 'exec'), namespace)
+		self.function = namespace['cycle']
+		self.state = self.initialState()
+	def __repr__(self):
+		return '<Codegen %d lines>' % (self.source.count('\n'))
+
+	def initialState(self):
+		netlist = self.netlist
+		return (0,)*(len(netlist.delays) + len(netlist.held()) + len(netlist.bookmarks)) + (None,)*len(netlist.bookmarks)
+
+	def generate(self):
+		netlist = self.netlist
+		lines = []
+		emit = lines.append
+		def ors(nets):
+			return ' | '.join('n%d' % net for net in sorted(set(nets))) or '0'
+
+		delays = ['n%d' % delay[0] for delay in netlist.delays]
+		memories = ['n%d' % index for index in netlist.held()]
+		bookstates = ['b%d' % k for k in range(len(netlist.bookmarks))]
+		bookmarks = ['k%d' % k for k in range(len(netlist.bookmarks))]
+		emit('def cycle(inbits, headr, age, state):')
+		emit('\tn0, n1 = 0, 1')
+		if delays or memories or bookmarks:
+			emit('\t%s, = state' % ', '.join(delays + memories + bookstates + bookmarks))
+
+		# Sources
+		for index, bit in netlist.inputs:
+			emit('\tn%d = inbits >> %d & 1' % (index, bit))
+		for index, bit in netlist.storagebits:
+			emit('\tn%d = headr >> %d & 1' % (index, bit))
+		for index in netlist.randoms:
+			emit('\tn%d = getrandbits(1)' % (index))
+		for index in netlist.pulses:
+			emit('\tn%d = 1 if age == 1 else 0' % (index))
+		for index in netlist.cyclic:
+			emit('\tn%d = 0' % (index))
+
+		# Gates, in netlist order
+		for op, index, a, b in netlist.gates:
+			if op == 'any':
+				emit('\tn%d = %s' % (index, ors(a)))
+			elif op == 'and':
+				emit('\tn%d = n%d & n%d' % (index, a, b))
+			elif op == 'or':
+				emit('\tn%d = n%d | n%d' % (index, a, b))
+			elif op == 'xor':
+				emit('\tn%d = n%d ^ n%d' % (index, a, b))
+			elif op == 'andnot':
+				emit('\tn%d = n%d & ~n%d' % (index, a, b))
+			elif op == 'memory':
+				emit('\tn%d = n%d if n%d else n%d' % (index, b, a, index))
+			elif op == 'cache':
+				emit('\tn%d = n%d' % (index, a))
+
+		# Storage, each unit with its own controls, on its own byte of the heads
+		heads = []
+		for unit, (read, write) in enumerate(Board.STORAGE_CONTROLS):
+			emit('\tctl%s = %s' % (read, ors(net for control, flavor, net in netlist.storagecontrols if flavor == read)))
+			emit('\tctl%s = %s' % (write, ors(net for control, flavor, net in netlist.storagecontrols if flavor == write)))
+			headw = [ors(net for bit, net in netlist.storagewrites if bit == 8*unit + index) for index in range(8)]
+			headw = ' | '.join('(%s) << %d' % (word, 8*unit + bit) for bit, word in enumerate(headw) if word != '0')
+			if headw:
+				used = 'ctl%s | ctl%s' % (write, read) if self.board.storagemode[unit:unit+1] == 'm' else 'ctl' + write
+				heads.append('(%s if %s else 0)' % (headw, used))
+		emit('\theadw = %s' % (' | '.join(heads) or '0'))
+		controls = ', '.join('ctl' + flavor for flavor in ''.join(Board.STORAGE_CONTROLS))
+
+		# Sleep and pause
+		sleep = ['SLEEP_RAMP[%s]' % ' + '.join('n%d' % net for net in nets) for nets in netlist.sleeps]
+		emit('\tsleep = %s' % (' + '.join(sleep) or '0'))
+		if netlist.pauses:
+			for scale, net in netlist.pauses:
+				emit('\tif n%d:' % (net))
+				emit('\t\tsleep += (headr & 0xff) * %r' % (scale))
+
+		# Bookmarks
+		emit('\tjumps = []')
+		for k, bookmark in enumerate(netlist.bookmarks):
+			emit('\tif b%d != n%d:' % (k, bookmark[0]))
+			emit('\t\tb%d = n%d' % (k, bookmark[0]))
+			emit('\t\tif b%d:' % (k))
+			emit('\t\t\tk%d = age' % (k))
+			emit('\t\telse:')
+			emit('\t\t\tjumps.append(k%d - age - 1)' % (k))
+			emit('\t\t\tk%d = None' % (k))
+
+		# Status and output
+		status = []
+		for statuscode in sorted(set(statuscode for statuscode, net in netlist.controls)):
+			status.append('(%d if %s else 0)' % (statuscode, ors(net for code, net in netlist.controls if code == statuscode)))
+		emit('\tstatuscode = %s' % (' | '.join(status) or '0'))
+		outbits = [ors(net for bit, net in netlist.outputs if bit == index) for index in range(8)]
+		outbits = ' | '.join('(%s) << %d' % (word, bit) for bit, word in enumerate(outbits) if word != '0') or '0'
+		emit('\toutbits = 0 if statuscode & %d else %s' % (Board.WRITE_HOLD, outbits))
+		emit('\tdebug = [%s]' % ', '.join('(%r, %d, %d, %d, n%d)' % debug for debug in netlist.debugs))
+
+		state = ['n%d' % delay[1] for delay in netlist.delays] + memories + bookstates + bookmarks
+		emit('\treturn (%s), outbits, statuscode, sleep, (%s), headw, jumps, debug' % (''.join(var + ', ' for var in state), controls))
+		return '\n'.join(lines) + '\n'
+
+	def run(self, inbits):
+		board = self.board
+		board.beginCycle(inbits)
+		for prepare in board.terminals[DummyPrepare]:
+			prepare()
+
+		self.state, outbits, statuscode, sleep, controls, headw, jumps, debug =\
+		    self.function(inbits, board.storageheadr, board.age, self.state)
+
+		board.outbits = outbits
+		board.addStatus(statuscode)
+		board.addSleep(sleep)
+		for flavor, value in zip(''.join(Board.STORAGE_CONTROLS), controls):
+			board.setStorageControl(self, flavor, value)
+		board.storageheadw |= headw
+		for jump in jumps:
+			board.setJump(jump)
+		for msg in debug:
+			board.addDebug(*msg)
+
+		for finalize in board.terminals[DummyFinalize]:
+			finalize()
+		return board.endCycle()
+
+	def marks(self):
+		# The marks are the last of the state
+		count = len(self.netlist.bookmarks)
+		return [mark for mark in self.state[len(self.state)-count:] if mark is not None]
+
+###                 ###
+#   Begin Circuit API   #
+###                 ###
+
+class History(object):
+	"""The input given to the circuit so far, addressed by position in
+	   the whole input. Bytes that can no longer be read again are
+	   dropped with keep, so only the bytes from start onward are held."""
+
+	def __init__(self):
+		self.data = bytearray()
+		self.start = 0
+		# The position of the byte given in the cycle of each live bookmark
+		self.marks = {}
+	def __len__(self):
+		return self.start + len(self.data)
+	def __getitem__(self, span):
+		# Only slices are needed; any part already dropped is left out
+		return bytes(self.data[max(span.start, self.start)-self.start:span.stop-self.start])
+
+	def extend(self, block):
+		self.data.extend(block)
+	def keep(self, position):
+		"""Drop every byte before position"""
+		position = min(position, len(self))
+		if position > self.start:
+			del self.data[:position-self.start]
+			self.start = position
+	def clamp(self, index):
+		"""Gives the position nearest to index that can still be read"""
+		return max(index, self.start)
+
+	def follow(self, index, live, jump):
+		"""Gives the position of the next byte to give the circuit, after
+		   a cycle that was given the byte before index, with live the
+		   ages of the bookmarks still marked, and jump as in RunResult"""
+		for age in live:
+			self.marks.setdefault(age, index-1)
+		if jump is not None:
+			if jump >= 0:
+				index = jump
+			else:
+				index += jump
+			# Input that was dropped cannot be read again
+			index = self.clamp(index)
+		if self.marks:
+			for age in [age for age in self.marks if age not in live]:
+				del self.marks[age]
+		return index
+	def floor(self, index):
+		"""Gives the earliest position a jump may still go back to, from
+		   index; no byte before it needs to be kept"""
+		return min([index-1] + list(self.marks.values()))
+
+# The ways a circuit can be run, as named by --engine
+ENGINES = ('poll', 'memo', 'iterative', 'netlist', 'codegen')
+
+def makeEngine(board, engine):
+	"""Gives the engine named engine, one of ENGINES, to run board. The
+	   poll engine is the board itself."""
+	if engine == 'memo':
+		return Memo(board)
+	elif engine == 'iterative':
+		return Iterative(board)
+	elif engine == 'netlist':
+		return Netlist(board)
+	elif engine == 'codegen':
+		return Codegen(Netlist(board))
+	return board
+
+def checkOptions(storage='s', limit=None, overflow='drop', engine='poll', lanes=64):
+	"""Raises ValueError if the options a circuit is run with are not
+	   valid, or do not fit together"""
+	if not (0 < len(storage) <= 2 and set(storage) <= set(STORAGE_MODES)):
+		# A second character gives the mode of a second storage unit, as in 'qs'
+		raise ValueError("'%s' is not a valid storage mode. Valid modes are one or two of: %s" %
+		                 (storage, ', '.join(STORAGE_MODES)))
+	if limit is not None and limit < 1:
+		raise ValueError('the storage limit must be at least 1')
+	if overflow not in STORAGE_OVERFLOWS:
+		raise ValueError("'%s' is not a valid storage overflow" % (overflow))
+	if overflow == 'spill' and set(storage) != {'s'}:
+		raise ValueError("only a stack can spill, not mode '%s'" % (storage))
+	if engine not in ENGINES:
+		raise ValueError("'%s' is not an engine" % (engine))
+	if lanes < 1:
+		raise ValueError('the number of lanes must be at least 1')
+
+class Circuit(object):
+	"""A circuit run within a program, rather than by the interpreter.
+	   Input is fed to it a chunk at a time, and the output for each
+	   chunk is given back, so no stream is read or written, and each
+	   circuit has its own board and options. The circuit runs as the
+	   interpreter runs it, except that sleep and pause elements are
+	   ignored. For example:
+
+	       circuit = Circuit.fromSpec(text, storage='q')
+	       output = circuit.feed(b'hello') + circuit.finish()
+
+	   storage, limit and overflow are as --storage-mode,
+	   --storage-limit and --storage-overflow, engine is as --engine,
+	   and cutoff is as --cutoff. If generator is given, it is called
+	   for a new iterable of single bytes to use once the input is
+	   finished, as with --generate."""
+
+	# How far history may run behind the input before it is trimmed
+	SLACK = 1 << 16
+
+	def __init__(self, layers, storage='s', limit=None, overflow='drop', engine='poll', cutoff=-1, generator=None):
+		checkOptions(storage, limit, overflow, engine)
+		self.layers = layers
+		self.config = BoardConfig(STORAGE=storage, STORAGE_LIMIT=limit, STORAGE_OVERFLOW=overflow, INSTRUMENT=False)
+		self.engineName = engine
+		self.cutoff = cutoff
+		self.generator = generator
+		self.warnings = []
+		self.nets = None
+		self.reset()
+		# Later boards are joined from the nets of the first
+		self.nets = self.board.saveNets()
+	def __repr__(self):
+		return '<Circuit %dx%dx%d %s>' % (self.board.w, self.board.h, self.board.d, self.engineName)
+
+	@classmethod
+	def fromSpec(cls, text, **options):
+		"""Gives the circuit of the text specification, which may start
+		   with a shebang (#!) line, as a spec file read by chip.py may.
+		   Any warnings about invalid characters are kept in warnings."""
+		warnings = []
+		circuit = cls(layoutSpec(stripShebang(text), warnings), **options)
+		circuit.warnings = warnings
+		return circuit
+
+	def reset(self):
+		"""Return the circuit to its state before any input"""
+		board = Board(self.config)
+		board.initialize([[[getElementType(char)(board, x, y, z, char) for x,char in enumerate(row)] for y,row in enumerate(layer)] for z,layer in enumerate(self.layers)], self.nets)
+		self.board = board
+		self.engine = makeEngine(board, self.engineName)
+		self.result = EMPTY_RUN_RESULT
+		self.inbits = 254
+		# The input so far, and the position of the next byte of it to
+		# be given to the circuit
+		self.history = History()
+		self.index = 0
+		self.total = 0
+		self.generated = None
+		self.terminated = False
+
+	def feed(self, data):
+		"""Gives the output of the circuit for data, the next part of its
+		   input. The circuit runs until it needs more input than it has
+		   been given, or terminates, after which its output is empty."""
+		if self.terminated:
+			return b''
+		self.history.extend(data)
+		return self.process(False)
+	def finish(self):
+		"""End the input, and give the rest of the output, which is only
+		   made by the input from generator, if there is one. The
+		   circuit is terminated after this, until it is reset."""
+		output = b''
+		if not self.terminated:
+			output = self.process(True)
+			self.terminated = True
+		return output
+	def iterProcess(self, chunks):
+		"""Feed each of chunks to the circuit, yielding the output for
+		   each in turn, and then any output from finishing the input"""
+		for chunk in chunks:
+			yield self.feed(chunk)
+		output = self.finish()
+		if output:
+			yield output
+
+	def process(self, finished):
+		"""Run the circuit over the input in history, and on generated
+		   input once the input is finished"""
+		engine = self.engine
+		history = self.history
+		output = bytearray()
+		while True:
+			if not (self.result.statuscode & Board.READ_HOLD):
+				if self.total >= self.cutoff > 0:
+					self.terminated = True
+					break
+				if self.index >= len(history):
+					if finished and self.generator is not None:
+						if self.generated is None:
+							self.generated = iter(self.generator())
+						history.extend(next(self.generated))
+						continue
+					break
+				self.inbits = history[self.index:self.index+1][0]
+				self.index += 1
+				self.total += 1
+
+			self.result = result = engine.run(self.inbits)
+
+			if not (result.statuscode & Board.WRITE_HOLD):
+				output.append(result.outbits)
+			if (result.statuscode & Board.TERMINATE):
+				self.terminated = True
+				break
+
+			self.index = history.follow(self.index, engine.marks(), result.jump)
+			# Drop the input no jump can reach
+			if self.index - history.start > Circuit.SLACK:
+				history.keep(history.floor(self.index))
+		return bytes(output)
+
 if __name__ == '__main__':
 	print('This file cannot be executed directly. Please use the chip interpreter instead.')
 
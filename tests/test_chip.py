@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+""" Chip Tests
+Run chip.py as a user would, over the sample specs and the circuits in
+tests/specs/. Some circuits never terminate, so their output is only
+read up to a count of bytes, and the interpreter is then stopped.
+Run with python -m unittest discover tests, or with pytest.
+"""
+
+from os import path
+import os, select, signal, subprocess, sys, tempfile, time, unittest
+
+TESTS = path.dirname(path.abspath(__file__))
+ROOT = path.dirname(TESTS)
+SPECS = path.join(ROOT, 'specs')
+
+def chip(args, data=b'', count=None, timeout=30):
+	"""Run chip.py with args on data, and give its output. If count is
+	   given, only that many bytes are read, and chip.py is stopped."""
+	proc = subprocess.Popen([sys.executable, path.join(ROOT, 'chip.py')] + args,
+	                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	try:
+		if count is None:
+			return proc.communicate(data, timeout=timeout)[0]
+		proc.stdin.write(data)
+		proc.stdin.close()
+		output = b''
+		deadline = time.monotonic() + timeout
+		while len(output) < count:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0 or not select.select([proc.stdout], [], [], remaining)[0]:
+				raise subprocess.TimeoutExpired(proc.args, timeout)
+			chunk = os.read(proc.stdout.fileno(), count - len(output))
+			if not chunk:
+				break
+			output += chunk
+		return output
+	finally:
+		proc.kill()
+		proc.wait()
+		proc.stdout.close()
+
+class DefaultPathTest(unittest.TestCase):
+	"""The default path, where a circuit may be run from a table"""
+
+	def test_held_read(self):
+		# truth.chp holds its read of 'a', and writes '1' until stopped
+		spec = path.join(SPECS, 'truth.chp')
+		self.assertEqual(chip([spec], b'a', count=64), b'1'*64)
+		self.assertEqual(chip(['-c', '40', '-z', spec], b'a', count=64), b'1'*64)
+
+class NetlistTest(unittest.TestCase):
+	"""Circuits lowered to a netlist, compared with the poll engine"""
+
+	def test_folded_loop(self):
+		# A loop whose gates are folded away one after another
+		spec = path.join(TESTS, 'specs', 'loopfold.chp')
+		expected = b'\x00\x00' + b'\x04'*22
+		for args in ([], ['--engine', 'poll'], ['--engine', 'netlist'], ['--engine', 'codegen']):
+			self.assertEqual(chip(args + [spec], b'abc', count=24), expected, args)
+
+class CacheTest(unittest.TestCase):
+	"""Caches read back into the nets that feed them"""
+
+	def test_cache_loop(self):
+		# A Cache that reads back its own net through a Switch
+		spec = path.join(TESTS, 'specs', 'cacheloop.chp')
+		data = bytes.fromhex('f3c95778e281a5eadafdb1fd028b4fd190e1746a')
+		for args in ([], ['--engine', 'poll'], ['--engine', 'memo'], ['--engine', 'netlist'], ['--engine', 'codegen']):
+			self.assertEqual(chip(args + [spec], data), bytes(13), args)
+
+	def test_poll_order(self):
+		# Which inputs of a net are polled decides what its Cache reads, so
+		# the same run must always give the same output
+		spec = path.join(TESTS, 'specs', 'cacheorder.chp')
+		data = bytes.fromhex('b36cc6ef0e07cd1562801172')
+		for _ in range(5):
+			self.assertEqual(chip(['--engine', 'poll', '-c', '12', '-z', spec], data),
+			                 bytes.fromhex('040000040004040400000400'))
+
+class MemoTest(unittest.TestCase):
+	"""The memo engine, which keeps each poll for the cycle"""
+
+	def test_deep_chain(self):
+		# Deeper than the recursion limit, where poll gives up and reads low
+		with tempfile.NamedTemporaryFile('w', suffix='.chp', encoding='utf-8') as f:
+			f.write('A' + '~'*3001 + 'a\n')
+			f.flush()
+			for engine in ('memo', 'iterative'):
+				self.assertEqual(chip(['--engine', engine, f.name], b'\x00\x01\x00\x01'), b'\x01\x00\x01\x00', engine)
+
+class RandomTest(unittest.TestCase):
+	"""Random elements, which give one value each cycle"""
+
+	def test_shared_random(self):
+		# In rand.chp, c and d are driven by the same ?
+		spec = path.join(SPECS, 'rand.chp')
+		for engine in ('poll', 'memo', 'iterative', 'netlist'):
+			output = chip(['--engine', engine, '-c', '500', '-z', spec])
+			self.assertEqual(len(output), 500)
+			for byte in output:
+				self.assertEqual(byte >> 2 & 1, byte >> 3 & 1, engine)
+
+class OptionsTest(unittest.TestCase):
+	"""Options that are not valid are refused before a circuit is run"""
+
+	def test_lanes(self):
+		spec = path.join(SPECS, 'cat.chp')
+		for lanes in ('0', '-3'):
+			proc = subprocess.run([sys.executable, path.join(ROOT, 'chip.py'), '-b', '--lanes', lanes, spec],
+			                      input=b'abc\n', capture_output=True, timeout=30)
+			self.assertEqual(proc.returncode, 2)
+			self.assertIn(b'lanes', proc.stderr)
+		self.assertEqual(chip(['-b', '--lanes', '2', spec], b'abc\n'), b'abc\n')
+
+class ServerTest(unittest.TestCase):
+	"""Circuits served over a Unix socket"""
+
+	def test_terminate(self):
+		# With -z, cat never terminates, so the batch for the client is
+		# still running when the server is told to stop
+		with tempfile.TemporaryDirectory() as tmp:
+			sock = path.join(tmp, 'chip.sock')
+			server = subprocess.Popen([sys.executable, path.join(ROOT, 'chip.py'), '--serve', sock, '-z',
+			                           path.join(SPECS, 'cat.chp')], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+			try:
+				deadline = time.monotonic() + 30
+				while not path.exists(sock):
+					self.assertLess(time.monotonic(), deadline)
+					time.sleep(0.05)
+				client = subprocess.Popen([sys.executable, path.join(ROOT, 'chip.py'), '--connect', sock, 'cat'],
+				                          stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+				client.stdin.write(b'hi')
+				client.stdin.close()
+				time.sleep(1)
+				server.send_signal(signal.SIGTERM)
+				self.assertEqual(server.wait(timeout=10), 0)
+				self.assertNotEqual(client.wait(timeout=10), 0)
+				self.assertFalse(path.exists(sock))
+			finally:
+				server.kill()
+				server.wait()
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+""" Chip Bench
+Benchmark the Chip interpreter. Every spec in specs/ is run on a fixed
+input corpus, and circuits generated by chipntimes.py (with and without
+-k) and chipword.py are run at increasing sizes, for each engine, and
+for the default path that chip.py takes when no engine is given. Each
+run is a separate process, and reports its setup time, cycles per
+second, output bytes per second, polls per cycle, and peak memory. The
+corpus is the same for every run of the same size, so results may be
+saved with --json, and compared against later with --baseline.
+"""
+
+from argparse import ArgumentParser
+from os import listdir, path
+from sys import argv, executable
+import json, random, resource, subprocess, sys, tempfile, time
+
+TOOLS = path.dirname(path.abspath(__file__))
+ROOT = path.dirname(TOOLS)
+sys.path.insert(0, ROOT)
+import chiplib
+# 'default' runs as chip.py does without --engine, from a table if it can
+ENGINES = ('default',) + chiplib.ENGINES
+# The engines that poll, and so have polls to count
+POLLING = ('poll', 'memo', 'iterative')
+
+class CycleLimit(Exception):
+	pass
+
+def work(resultpath, count, limit, chipargs):
+	"""Run chip.py in this process with chipargs, for at most limit
+	   cycles, and write what was measured to resultpath. If count, the
+	   board is instrumented, and its polls are counted, rather than the
+	   runtime being measured."""
+	import chip
+	argv[1:] = chipargs
+	spec = chip.init()
+	chip.Cfg.INSTRUMENT = count
+	start = time.perf_counter()
+	circuit, board, engine = chip.setup(spec)
+	process = None
+	if chip.Cfg.ENGINE is None:
+		process = chip.tabulate(board)
+	setup = time.perf_counter() - start
+	age = board.age
+	cycles = 0
+	if process is not None:
+		table = process
+		# A state machine counts its own cycles, and may terminate within a
+		# chunk, while a truth table runs one cycle for each byte
+		machine = getattr(table, '__self__', None)
+		def process(chunk):
+			nonlocal cycles
+			if cycles >= limit:
+				raise CycleLimit()
+			chunk = chunk[:limit - cycles]
+			cycles += len(chunk)
+			return table(chunk)
+	else:
+		run = engine.run
+		def limited(inbits):
+			# Some specs only terminate on the input they were written for
+			if board.age - age >= limit:
+				raise CycleLimit()
+			return run(inbits)
+		engine.run = limited
+	start = time.perf_counter()
+	try:
+		if process is not None:
+			chip.stream(process)
+		else:
+			chip.run(circuit, board, engine)
+	except CycleLimit:
+		pass
+	elapsed = time.perf_counter() - start
+	if process is not None and machine is not None:
+		cycles = machine.age
+	result = {'setup':setup,
+	          'time':elapsed,
+	          'cycles':board.age - age + cycles,
+	          'polls':sum(board.stats[k] for k in ('poll.neighbor', 'poll.internal', 'poll.frame')),
+	          # Kilobytes, on Linux
+	          'maxrss':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+	with open(resultpath, 'w') as f:
+		json.dump(result, f)
+
+def measure(specpath, engine, inputpath, generate, limit, count=False):
+	"""Run a spec in a new process, and give its measurements, with the
+	   count of output bytes"""
+	chipargs = [] if engine == 'default' else ['--engine', engine]
+	if generate:
+		chipargs.append('-z')
+	chipargs.append(specpath)
+	if inputpath is not None:
+		chipargs.append(inputpath)
+	with tempfile.NamedTemporaryFile('r', suffix='.json') as f:
+		proc = subprocess.run([executable, path.abspath(__file__), '--worker', f.name, str(int(count)), str(limit)] + chipargs,
+		                      stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		if proc.returncode != 0:
+			raise RuntimeError('%s failed with the %s engine:\n%s' % (specpath, engine, proc.stderr.decode('utf-8', 'replace')))
+		result = json.load(f)
+	result['output'] = len(proc.stdout)
+	return result
+
+def corpus(size):
+	"""Gives size bytes of printable text, the same for every run"""
+	rand = random.Random(size)
+	text = ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz0123456789 .,\n') for i in range(size))
+	return text.encode('ascii')
+
+def cases(scales):
+	"""Yields the name of each benchmark, with the path of its spec, or
+	   None and the spec generated for it"""
+	specs = path.join(ROOT, 'specs')
+	for name in sorted(listdir(specs)):
+		if name.endswith('.chp'):
+			yield name, path.join(specs, name), None
+	for scale in scales:
+		yield 'chipntimes %d' % (scale), None, tool('chipntimes.py', str(scale))
+		yield 'chipntimes -k %d' % (scale), None, tool('chipntimes.py', '-k', str(scale))
+		yield 'chipword %d' % (scale), None, tool('chipword.py', '--', corpus(scale).decode('ascii').replace('\n', ' '))
+
+def tool(name, *args):
+	"""Gives the spec generated by one of the tools"""
+	return subprocess.run([executable, path.join(TOOLS, name)] + list(args), stdout=subprocess.PIPE,
+	                      check=True).stdout.decode('utf-8')
+
+def bench(engines, size, scales, repeat, limit, only):
+	"""Run every benchmark on each engine, and give the results keyed by
+	   'name/engine'. The fastest of repeat runs is kept."""
+	results = {}
+	with tempfile.TemporaryDirectory() as tmp:
+		inputpath = path.join(tmp, 'corpus')
+		with open(inputpath, 'wb') as f:
+			f.write(corpus(size))
+		for name, specpath, spec in cases(scales):
+			if only and not any(pattern in name for pattern in only):
+				continue
+			# The specs are given the corpus, and the generated circuits zeroes
+			given = inputpath
+			if specpath is None:
+				specpath = path.join(tmp, 'generated.chp')
+				with open(specpath, 'w') as f:
+					f.write(spec)
+				given = None
+			for engine in engines:
+				runs = [measure(specpath, engine, given, given is None, limit) for i in range(repeat)]
+				best = min(runs, key=lambda run: run['time'])
+				polls = None
+				if engine in POLLING:
+					counted = measure(specpath, engine, given, given is None, limit, count=True)
+					polls = counted['polls'] / counted['cycles'] if counted['cycles'] else 0.0
+				result = {'name':name,
+				          'engine':engine,
+				          'setup':min(run['setup'] for run in runs),
+				          'cycles':best['cycles'],
+				          'cycles/s':best['cycles'] / best['time'] if best['time'] else 0.0,
+				          'bytes/s':best['output'] / best['time'] if best['time'] else 0.0,
+				          'polls/cycle':polls,
+				          'maxrss':max(run['maxrss'] for run in runs)}
+				results['%s/%s' % (name, engine)] = result
+				report(result)
+	return results
+
+def report(result):
+	polls = '-' if result['polls/cycle'] is None else '%.1f' % (result['polls/cycle'])
+	print('%-20s %-10s %9.1f %9d %12.1f %12.1f %12s %9d' % (result['name'], result['engine'], result['setup']*1000,
+	      result['cycles'], result['cycles/s'], result['bytes/s'], polls, result['maxrss']), flush=True)
+
+def compare(results, baseline, threshold):
+	"""Print the change in cycles per second of each benchmark from the
+	   baseline, and give the count of regressions worse than threshold"""
+	regressions = 0
+	print('\n%-20s %-10s %12s %12s %8s' % ('Benchmark', 'Engine', 'Baseline', 'Current', 'Change'))
+	for key, result in results.items():
+		if key not in baseline:
+			continue
+		old = baseline[key]['cycles/s']
+		new = result['cycles/s']
+		change = new / old - 1 if old else 0.0
+		flag = ''
+		if change < -threshold:
+			flag = '  REGRESSION'
+			regressions += 1
+		print('%-20s %-10s %12.1f %12.1f %+7.1f%%%s' % (result['name'], result['engine'], old, new, change*100, flag))
+	return regressions
+
+if __name__ == '__main__':
+	if len(argv) > 1 and argv[1] == '--worker':
+		work(argv[2], argv[3] == '1', int(argv[4]), argv[5:])
+		exit(0)
+
+	parser = ArgumentParser(description='Benchmark the Chip interpreter over specs/ and generated circuits.')
+	parser.add_argument('-e', '--engine', action='append', dest='engines', choices=ENGINES, help='An engine to benchmark; '+
+	                                      'may be given more than once, and \'default\' is the path chip.py takes when no engine is given. By '+
+	                                      'default, every engine and the default path are benchmarked.')
+	parser.add_argument('-n', '--size', action='store', dest='size', default=4096, type=int, metavar='N', help='The size '+
+	                                    'of the input corpus given to each spec, in bytes. The default is 4096.')
+	parser.add_argument('-s', '--scale', action='append', dest='scales', type=int, metavar='N', help='A size to generate '+
+	                                     'circuits at; may be given more than once. chipntimes circuits run for N cycles, '+
+	                                     'and chipword circuits print N bytes. By default, 16, 128 and 1024.')
+	parser.add_argument('-r', '--repeat', action='store', dest='repeat', default=3, type=int, metavar='N', help='Run each '+
+	                                      'benchmark N times, and keep the fastest. The default is 3.')
+	parser.add_argument('-l', '--limit', action='store', dest='limit', default=100000, type=int, metavar='N', help='Stop '+
+	                                     'each run after N cycles, as some specs only terminate on particular input. The '+
+	                                     'default is 100000.')
+	parser.add_argument('-k', '--only', action='append', dest='only', metavar='TEXT', help='Only run the benchmarks '+
+	                                    'whose name contains TEXT; may be given more than once.')
+	parser.add_argument('--json', action='store', dest='json', default=None, metavar='FILE', help='Write the results '+
+	                              'to FILE, to be given as a baseline to a later run.')
+	parser.add_argument('--baseline', action='store', dest='baseline', default=None, metavar='FILE', help='Compare the '+
+	                                  'results to those saved in FILE with --json, and exit with status 1 if any '+
+	                                  'benchmark regressed.')
+	parser.add_argument('--threshold', action='store', dest='threshold', default=0.1, type=float, metavar='F', help='The '+
+	                                   'fraction by which cycles per second must drop to count as a regression. The '+
+	                                   'default is 0.1.')
+	args = parser.parse_args()
+
+	print('%-20s %-10s %9s %9s %12s %12s %12s %9s' % ('Benchmark', 'Engine', 'Setup ms', 'Cycles', 'Cycles/s',
+	                                                  'Bytes/s', 'Polls/cycle', 'Peak KiB'))
+	results = bench(args.engines or ENGINES, args.size, args.scales or [16, 128, 1024], args.repeat, args.limit, args.only)
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent='\t')
+			f.write('\n')
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		if compare(results, baseline, args.threshold):
+			exit(1)